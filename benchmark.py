@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import json
+import time
+import logging
+import argparse
+import threading
+from client import galaxy_instance
+from metrics import percentile
+from mock_galaxy import MockGalaxy
+from planning import AdmissionController
+from poller import StatePoller, scheduler
+import bioblend_test_workflows
+import run_wf
+
+# The harness logs every poll, so results go to a logger of their own
+log = logging.getLogger('benchmark')
+SIZES = (10, 100, 1000)
+SCENARIOS = ('watch', 'pipeline', 'test_workflows')
+
+
+class CompletionLog(object):
+    """Stands in for a report.XunitReport, noting when each invocation's
+    completion suite is made."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # invoke_id -> when the harness saw it finish
+        self.seen = {}
+
+    def add(self, suite):
+        if suite.name.endswith('Workflow Completion'):
+            invoke_id = suite.test_cases[0].classname.split('.')[2]
+            with self._lock:
+                self.seen[invoke_id] = time.time()
+
+    def close(self):
+        pass
+
+
+def bench_watch(mock, gi, n):
+    # The watch loop alone, over invocations submitted up front
+    wf_id = mock.add_workflow()
+    hist = gi.histories.create_history(name='Benchmark')
+    invocations = [(wf_id, gi.workflows.invoke_workflow(wf_id, history_id=hist['id'])['id']) for _ in range(n)]
+    mock.reset_calls()
+    seen = {}
+    started = time.time()
+    for tc_watch in run_wf.watch_workflow_invocations(gi, invocations, poller=StatePoller(gi)):
+        seen[tc_watch._classname.split('.')[2]] = time.time()
+    return started, seen
+
+
+def bench_pipeline(mock, gi, n):
+    # History setup, retrieve_and_rename, invocation and watching per organism
+    wf_id = mock.add_workflow()
+    wf = gi.workflows.get_workflows(workflow_id=wf_id)[0]
+    log = CompletionLog()
+    mock.reset_calls()
+    started = time.time()
+    run_wf.run_pipeline(gi, wf, ['Org%s' % i for i in range(n)], 'Benchmark Org=%s', run_wf.map_inputs,
+                        queue_size=n, poller=StatePoller(gi), report=log)
+    return started, log.seen
+
+
+def bench_test_workflows(mock, gi, n):
+    # bioblend_test_workflows, all tests submitted at once
+    tests = [{'id': mock.add_workflow(), 'inputs': {}} for _ in range(n)]
+    mock.reset_calls()
+    started = time.time()
+    bioblend_test_workflows.test_workflows(gi, None, tests, admission=AdmissionController(gi, max_inflight=n))
+    # Only the harness' end is visible here, so this is the detection of
+    # whichever invocation finished last
+    ended = time.time()
+    last = max(mock.invocations, key=lambda invoke_id: mock.finished_at(invoke_id) or 0)
+    return started, {last: ended}
+
+
+def run(scenario, n, **mock_args):
+    bench = globals()['bench_%s' % scenario]
+    with MockGalaxy(**mock_args) as mock:
+        gi = galaxy_instance(mock.url, 'benchmark')
+        started, seen = bench(mock, gi, n)
+        wall = time.time() - started
+        latencies = []
+        for invoke_id, at in seen.items():
+            finished = mock.finished_at(invoke_id)
+            if finished is not None:
+                latencies.append(max(at - finished, 0))
+        return {
+            'scenario': scenario,
+            'invocations': n,
+            'wall_time': wall,
+            'api_calls': mock.api_calls(),
+            'api_calls_per_invocation': float(mock.api_calls()) / n,
+            'detection_latency': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'max': max(latencies) if latencies else None,
+            },
+            'calls': dict(mock.calls),
+        }
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="""Measure the harness itself against a mock galaxy
+    (see mock_galaxy.py): wall time, API calls per invocation, and how long after an invocation
+    finishes the harness notices.""")
+
+    parser.add_argument('-s', '--scenario', dest="scenarios", action='append', choices=SCENARIOS,
+                        help="""What to drive; may be repeated (default: all)""")
+    parser.add_argument('-n', '--invocations', dest="sizes", type=int, action='append',
+                        help="""Number of invocations; may be repeated (default: %s)""" % ', '.join(map(str, SIZES)))
+    parser.add_argument('-o', '--output', dest="output", default='benchmark.json',
+                        help="""Location to store the results in""")
+    parser.add_argument('--max-rps', dest="max_rps", type=run_wf.positive_float, default=scheduler.rate,
+                        help="""Most polling requests per second to make of galaxy, across all watchers""")
+    parser.add_argument('--job-duration', dest="job_duration", type=float, default=2.0,
+                        help="""Seconds each mock job runs for""")
+    parser.add_argument('--queue-time', dest="queue_time", type=float, default=0.5,
+                        help="""Seconds each mock job queues for""")
+    parser.add_argument('--steps', dest="steps", type=int, default=3,
+                        help="""Tool steps in each mock workflow""")
+    parser.add_argument('--failure-rate', dest="failure_rate", type=float, default=0.0,
+                        help="""Fraction of mock jobs that fail""")
+    parser.add_argument('--latency', dest="latency", type=float, default=0.01,
+                        help="""Seconds every mock response is delayed by""")
+    parser.add_argument('--seed', dest="seed", type=int, default=None,
+                        help="""Seed for the mock's job times and failures""")
+    args = parser.parse_args()
+    scheduler.rate = args.max_rps
+    logging.getLogger().setLevel(logging.WARNING)
+    log.setLevel(logging.INFO)
+
+    results = []
+    for scenario in args.scenarios or SCENARIOS:
+        for n in args.sizes or SIZES:
+            result = run(scenario, n, job_duration=args.job_duration, queue_time=args.queue_time,
+                         steps=args.steps, failure_rate=args.failure_rate, latency=args.latency, seed=args.seed)
+            detection = result['detection_latency']
+            log.info("%-14s %5s invocations: %7.1fs wall, %6.1f calls/invocation, detection p50 %s p95 %s",
+                     scenario, n, result['wall_time'], result['api_calls_per_invocation'],
+                     'n/a' if detection['p50'] is None else '%.1fs' % detection['p50'],
+                     'n/a' if detection['p95'] is None else '%.1fs' % detection['p95'])
+            results.append(result)
+    with open(args.output, 'w') as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    __main__()
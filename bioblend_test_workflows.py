@@ -6,13 +6,24 @@ import json
 import time
 import logging
 import datetime
-from bioblend import galaxy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bioblend import ConnectionError
+from cache import CACHE_DB, ResultCache, RunHistory
+from client import galaxy_instance
+from metrics import step_timings
+from planning import AdmissionController
+from report import ReportFile
+from tracing import tracer
+import run_wf
 
 logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.DEBUG)
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("bioblend").setLevel(logging.WARNING)
 NOW = datetime.datetime.now()
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BUILD_ID = os.environ.get('BUILD_NUMBER', 'Manual-%s' % NOW.strftime('%Y.%m.%dT%H:%M'))
+# Longest wait between polls of a running test's invocation, in seconds
+POLL_INTERVAL = 5
 
 class Timer:
     def __enter__(self):
@@ -44,6 +55,13 @@ class XUnitReportBuilder(object):
         }
         self.test_cases = []
         self.suite_name = suite_name
+        self.report = None
+
+    def stream(self, path):
+        # Keep a complete report at ``path`` as each test is added; without
+        # it the report is only had from serialize()
+        tail = self.XUNIT_TPL.split('{test_cases}')[1]
+        self.report = ReportFile(path, self.__head(), tail)
 
     def ok(self, classname, test_name, time=0):
         logging.info("OK: [%s] %s", classname, test_name)
@@ -52,12 +70,14 @@ class XUnitReportBuilder(object):
 
     def error(self, classname, test_name, errorMessage, errorDetails="", time=0):
         logging.info("ERROR: [%s] %s", classname, test_name)
+        self.xunit_data['errors'] += 1
         self.xunit_data['total'] += 1
         self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
             errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
 
     def failure(self, classname, test_name, errorMessage, errorDetails="", time=0):
         logging.info("FAIL: [%s] %s", classname, test_name)
+        self.xunit_data['failures'] += 1
         self.xunit_data['total'] += 1
         self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
             errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
@@ -70,13 +90,21 @@ class XUnitReportBuilder(object):
 
     def __add_test(self, name, classname, errors, time=0):
         t = 'time="%s"' % time
-        self.test_cases.append(
-            self.TESTCASE_TPL.format(name=name, error=errors, classname=classname, time=t))
+        test_case = self.TESTCASE_TPL.format(name=name, error=errors, classname=classname, time=t)
+        self.test_cases.append(test_case)
+        if self.report is not None:
+            self.report.append(test_case, self.__head())
 
     def serialize(self):
-        self.xunit_data['test_cases'] = '\n'.join(self.test_cases)
-        self.xunit_data['suite_name'] = self.suite_name
-        return self.XUNIT_TPL.format(**self.xunit_data)
+        return self.XUNIT_TPL.format(suite_name=self.suite_name, test_cases='\n'.join(self.test_cases),
+                                     **self.xunit_data)
+
+    def __head(self):
+        return self.XUNIT_TPL.split('{test_cases}')[0].format(suite_name=self.suite_name, **self.xunit_data)
+
+    def close(self):
+        if self.report is not None:
+            self.report.close()
 
 
 xunit = XUnitReportBuilder('wf_tester')
@@ -101,91 +129,165 @@ def __main__():
     parser.add_argument('-s', '--dry-run', dest="dry_run",
                         help="""Do not execute workflow, just show the call it would have made, helpful for identifying
                         the right parameters""", action="store_true", default=False)
-    parser.add_argument('-x', '--xunit-output', dest="xunit_output", type=argparse.FileType('w'), default='report.xml',
-                        help="""Location to store xunit report in""")
+    parser.add_argument('-x', '--xunit-output', dest="xunit_output", default='report.xml',
+                        help="""Location to store xunit report in, updated as each test finishes""")
+    parser.add_argument('--max-queued', dest="max_queued", type=int, default=None,
+                        help="""Run the workflows concurrently, submitting only while fewer than this many of our
+                        jobs are new, queued or running on the server""")
+    parser.add_argument('--max-in-flight', dest="max_inflight", type=int, default=None,
+                        help="""Run the workflows concurrently, at most this many at once""")
+    parser.add_argument('--memoize', dest="memoize", action="store_true", default=False,
+                        help="""Skip workflows that passed before, if neither they nor their inputs have changed since""")
+    parser.add_argument('--memoize-ttl', dest="memoize_ttl", type=float, default=24 * 7,
+                        help="""Hours a memoized pass stays good for""")
+    parser.add_argument('--force', dest="force", action="store_true", default=False,
+                        help="""Run every workflow, even those with a memoized pass""")
+    parser.add_argument('--cache-db', dest="cache_db", default=CACHE_DB,
+                        help="""Local cache of memoized results""")
+    parser.add_argument('--no-history', dest="history", action="store_false", default=True,
+                        help="""Don't record this build's durations in the run history (see compare_runs.py)""")
+    parser.add_argument('--trace', dest="trace", default=None,
+                        help="""Write a Chrome trace (chrome://tracing, Perfetto) of every galaxy API call to this file""")
     args = parser.parse_args()
+    if args.trace:
+        tracer.start()
 
     workflows_to_test = yaml.load(args.yaml)
 
-    gi = galaxy.GalaxyInstance(args.url, args.key)
+    gi = galaxy_instance(args.url, args.key)
     data_library = gi.libraries.get_libraries(library_id=args.data_library_id)
-    test_workflows(gi, data_library, workflows_to_test, dry_run=args.dry_run)
-
-    # Write out the report
-    args.xunit_output.write(xunit.serialize())
+    admission = None
+    if args.max_queued or args.max_inflight:
+        admission = AdmissionController(gi, max_jobs=args.max_queued, max_inflight=args.max_inflight)
+    results_cache = None
+    if args.memoize:
+        results_cache = ResultCache(args.cache_db, ttl=args.memoize_ttl * 60 * 60)
+    history = RunHistory(args.cache_db, BUILD_ID) if args.history else None
+    xunit.stream(args.xunit_output)
+    try:
+        test_workflows(gi, data_library, workflows_to_test, dry_run=args.dry_run, admission=admission,
+                       results_cache=results_cache, force=args.force, history=history)
+    finally:
+        # Write out the final report
+        xunit.close()
+        if args.trace:
+            tracer.dump(args.trace)
 
 
 def get_library(gio, data_library_name):
     return gio.libraries.get('a411ce27cdcc0a37')
 
 
-def test_workflows(gi, data_library, workflows_to_test, dry_run=False):
-    for wft in workflows_to_test:
+def test_workflows(gi, data_library, workflows_to_test, dry_run=False, admission=None, results_cache=None,
+                   force=False, history=None):
+    # One at a time, or with an admission controller all at once, each
+    # submitted as soon as the server has room for it
+    workers = len(workflows_to_test) if admission is not None else 1
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = dict((pool.submit(run_workflow, gi, wft, admission, results_cache, force, history), wft)
+                       for wft in workflows_to_test)
+        # Report each as it finishes, so the streamed report is current
+        for future in as_completed(futures):
+            wft = futures[future]
+            try:
+                wf, result, result_extra, start_time, finish_time = future.result()
+            except Exception as e:
+                logging.exception("Running %s failed", wft['id'])
+                xunit.error('workflow_test', wft.get('name', wft['id']), 'Workflow could not be run',
+                            errorDetails=str(e))
+                continue
+            report_result(wft, wf, result, result_extra, finish_time - start_time)
+
+
+def report_result(wft, wf, result, result_extra, elapsed):
+    if result == 'Cached':
+        # Passed before and nothing has changed since
+        xunit.ok('workflow_test', wf['name'], time=elapsed)
+        return
+    # If we expect or allow failure
+    if wft.get('failure_expected', False) or wft.get('failure_tolerated', False):
+        # Then the results are inverted, success is actually a failure.
+        if result == 'Success':
+            xunit.failure('workflow_test', wf['name'], 'Workflow execution succeeded (failure expected)',
+                        time=elapsed)
+        else:
+            xunit.ok('workflow_test', wf['name'], time=elapsed)
+    else:
+        # Otherwise, per normal.
+        if result == 'Success':
+            xunit.ok('workflow_test', wf['name'], time=elapsed)
+        else:
+            xunit.failure('workflow_test', wf['name'], 'Workflow execution failed',
+                        errorDetails=json.dumps(result_extra, indent=2),
+                        time=elapsed)
+
+
+def run_workflow(gi, wft, admission=None, results_cache=None, force=False, history=None):
+    # Get our workflow info from the server
+    try:
+        wf = gi.workflows.get_workflows(workflow_id=wft['id'])[0]
+    except:
+        gi.workflows.import_shared_workflow(wft['id'])
+        wf = gi.workflows.get_workflows(workflow_id=wft['id'])[0]
+
+    memo_key = None
+    if results_cache is not None:
+        try:
+            memo_key = results_cache.key(gi, wf['id'], wft)
+        except ConnectionError as e:
+            logging.warning("Could not fingerprint %s, running it: %s", wf['name'], e)
+        hit = None if memo_key is None or force else results_cache.lookup(memo_key)
+        if hit is not None:
+            invocation_id, elapsed = hit
+            logging.info("Skipping %s, unchanged since invocation %s passed", wf['name'], invocation_id)
+            return wf, 'Cached', invocation_id, 0, elapsed
+
+    if admission is not None:
+        admission.admit()
+    try:
         # Start time
         start_time = time.time()
-        # Get our workflow info from the server
-        try:
-            wf = gi.workflows.get_workflows(workflow_id=wft['id'])[0]
-        except:
-            gi.workflows.import_shared_workflow(wft['id'])
-            wf = gi.workflows.get_workflows(workflow_id=wft['id'])[0]
-
         # Construct a hsitory name
         history_name = "TEST_RUN_%s: %s" % (time.strftime("%Y-%m-%d"), wf['name'])
         # Logging, in case anyone is watching.
         logging.info("Running workflow: %s with results to: %s" % (wf['name'], history_name))
 
         # Launch workflow
-        invocation = gi.workflows.invoke_workflow(
-            wf['id'],
-            inputs=wft['inputs'],
-            history_name=history_name,
-        )
-
-        result, result_extra = watch_workflow_invocation(gi, wf['id'], invocation['id'])
-        # Finish time
-        finish_time = time.time()
-        # If we expect or allow failure
-        if wft.get('failure_expected', False) or wft.get('failure_tolerated', False):
-            # Then the results are inverted, success is actually a failure.
-            if result == 'Success':
-                xunit.failure('workflow_test', wf['name'], 'Workflow execution succeeded (failure expected)',
-                            time=finish_time - start_time)
-            else:
-                xunit.ok('workflow_test', wf['name'], time=finish_time - start_time)
-        else:
-            # Otherwise, per normal.
-            if result == 'Success':
-                xunit.ok('workflow_test', wf['name'], time=finish_time - start_time)
-            else:
-                xunit.failure('workflow_test', wf['name'], 'Workflow execution failed',
-                            errorDetails=json.dumps(result_extra, indent=2),
-                            time=finish_time - start_time)
+        with tracer.span('workflow_launch', workflow=wf['id']):
+            invocation = gi.workflows.invoke_workflow(
+                wf['id'],
+                inputs=wft['inputs'],
+                history_name=history_name,
+            )
+
+        with tracer.span('workflow_watch', invocation=invocation['id']):
+            result, result_extra = watch_workflow_invocation(gi, wf['id'], invocation['id'])
+    finally:
+        if admission is not None:
+            admission.done()
+    # Finish time
+    finish_time = time.time()
+    if history is not None and result == 'Success':
+        # Workflow tests have no organism
+        history.record_run(wf['id'], None, step_timings(gi, wf['id'], invocation['id']))
+    if memo_key is not None:
+        # Only passes are remembered, anything else runs again next time
+        failure_expected = wft.get('failure_expected', False) or wft.get('failure_tolerated', False)
+        if (result == 'Success') != bool(failure_expected):
+            results_cache.record(memo_key, wf['id'], invocation['id'], finish_time - start_time)
+    return wf, result, result_extra, start_time, finish_time
 
 
 def watch_workflow_invocation(gi, wf_id, invoke_id):
-    latest_state = None
-    while True:
-        # Fetch the current state
-        latest_state = gi.workflows.show_invocation(wf_id, invoke_id)
-        # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
-        if latest_state['state'] == 'scheduled':
-            steps = latest_state['steps']
-            # Get step states
-            states = [step['state'] for step in steps]
-            # If any state is in error,
-            logging.info("  Checking workflow %s states: %s", wf_id, '|'.join(map(str, states)))
-            if any([state == 'error' for state in states]):
-                # We bail
-                return 'Fail', latest_state
-
-            # If all OK
-            if all([state is None or state == 'ok'
-                    for state in states]):
-                return "Success", None
-                # We can finish
-        time.sleep(5)
-    return 'Fail', latest_state
+    # The pipelines' watcher, which polls job summaries rather than whole
+    # invocations; it raises with the full invocation on failure. Its
+    # backoff is capped at the old fixed interval, so a test is never
+    # reported much later than it finishes.
+    try:
+        run_wf.watch_workflow_invocation(gi, wf_id, invoke_id, max_delay=POLL_INTERVAL)
+    except Exception as e:
+        return 'Fail', e.args[0] if e.args else str(e)
+    return 'Success', None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import hashlib
+import datetime
+import logging
+import sqlite3
+import threading
+import requests
+from bioblend import ConnectionError
+from client import make_session
+from poller import scheduler
+
+CACHE_DB = '.harness_cache.sqlite'
+# Datasets in these states can't stand in for a fresh upload
+UNUSABLE_DATASET_STATES = ('error', 'discarded', 'failed_metadata')
+# Keep-alive connections to Apollo, one signal lookup makes many requests
+apollo_session = make_session(pool_size=8)
+
+
+def hash_file(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def dataset_usable(gi, dataset_id):
+    # True if the dataset still exists on the server and can be copied
+    try:
+        dataset = gi.datasets.show_dataset(dataset_id)
+    except ConnectionError:
+        return False
+    return not dataset.get('deleted') and not dataset.get('purged') and \
+        dataset.get('state') not in UNUSABLE_DATASET_STATES
+
+
+def copy_dataset(gi, history_id, dataset_id):
+    # Server side copy of an existing dataset into another history
+    return gi.histories._post({'source': 'hda', 'content': dataset_id}, id=history_id, contents=True)
+
+
+def parse_time(value):
+    # Galaxy's timestamps are naive UTC, with or without microseconds
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Unknown time format: %s" % value)
+
+
+def apollo_signal(organism):
+    # A cheap change signal for an organism's annotations: its sequence and
+    # feature counts and newest feature modification time, from Apollo's web
+    # services. None (so nothing is cached) if Apollo isn't configured.
+    url = os.environ.get('APOLLO_URL')
+    if not url:
+        return None
+    auth = {
+        'username': os.environ.get('APOLLO_USERNAME'),
+        'password': os.environ.get('APOLLO_PASSWORD'),
+    }
+    try:
+        r = apollo_session.post(url + '/organism/getSequencesForOrganism', json=dict(auth, organism=organism))
+        r.raise_for_status()
+        sequences = [sequence['name'] if isinstance(sequence, dict) else sequence
+                     for sequence in r.json()['sequences']]
+        count, latest = 0, 0
+        for sequence in sequences:
+            r = apollo_session.post(url + '/annotationEditor/getFeatures',
+                                    json=dict(auth, organism=organism, sequence=sequence))
+            r.raise_for_status()
+            features = r.json()['features']
+            count += len(features)
+            latest = max([latest] + [feature.get('date_last_modified', 0) for feature in features])
+    except (requests.RequestException, KeyError, ValueError) as e:
+        logging.warning("Could not get an Apollo revision for %s: %s", organism, e)
+        return None
+    return '%s:%s:%s' % (len(sequences), count, latest)
+
+
+class SqliteCache(object):
+    """Base for the harness' local caches, all kept in one SQLite file.
+
+    Subclasses set ``SCHEMA``. The connection is shared between threads,
+    guarded by a lock.
+    """
+    SCHEMA = ''
+
+    def __init__(self, path=CACHE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(self.SCHEMA)
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _execute(self, sql, *args):
+        with self._lock, self._db:
+            self._db.execute(sql, args)
+
+
+class UploadIndex(SqliteCache):
+    """SHA-256 of local files -> the Galaxy dataset they were uploaded as."""
+    SCHEMA = """CREATE TABLE IF NOT EXISTS uploads (
+        sha256 TEXT PRIMARY KEY,
+        dataset_id TEXT NOT NULL,
+        name TEXT,
+        recorded REAL
+    )"""
+
+    def lookup(self, gi, sha256):
+        rows = self._query('SELECT dataset_id FROM uploads WHERE sha256 = ?', sha256)
+        if not rows:
+            return None
+        dataset_id = rows[0][0]
+        if not dataset_usable(gi, dataset_id):
+            logging.info("Dataset %s for %s is gone, forgetting it", dataset_id, sha256)
+            self._execute('DELETE FROM uploads WHERE sha256 = ?', sha256)
+            return None
+        return dataset_id
+
+    def record(self, sha256, dataset_id, name=None):
+        self._execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)',
+                      sha256, dataset_id, name, time.time())
+
+
+class ExportCache(SqliteCache):
+    """Webapollo export outputs per organism, reused for as long as the
+    organism's change signal (see :func:`apollo_signal`) stays the same."""
+    SCHEMA = """CREATE TABLE IF NOT EXISTS exports (
+        organism TEXT PRIMARY KEY,
+        signal TEXT NOT NULL,
+        datasets TEXT NOT NULL,
+        recorded REAL
+    )"""
+
+    def __init__(self, path=CACHE_DB, signal=apollo_signal, max_age=None):
+        SqliteCache.__init__(self, path)
+        self.signal = signal
+        self.max_age = max_age
+
+    def lookup(self, gi, organism):
+        # Returns the current signal, and {file_ext: dataset_id} on a hit
+        signal = self.signal(organism)
+        if signal is None:
+            return None, None
+        rows = self._query('SELECT signal, datasets, recorded FROM exports WHERE organism = ?', organism)
+        if not rows or rows[0][0] != signal:
+            return signal, None
+        if self.max_age is not None and time.time() - rows[0][2] > self.max_age:
+            return signal, None
+        datasets = json.loads(rows[0][1])
+        if not all(dataset_usable(gi, dataset_id) for dataset_id in datasets.values()):
+            logging.info("Cached export of %s is gone, forgetting it", organism)
+            self._execute('DELETE FROM exports WHERE organism = ?', organism)
+            return signal, None
+        return signal, datasets
+
+    def record(self, organism, signal, datasets):
+        if signal is None:
+            return
+        self._execute('INSERT OR REPLACE INTO exports VALUES (?, ?, ?, ?)',
+                      organism, signal, json.dumps(datasets), time.time())
+
+    def copy_into(self, gi, hist, organism, datasets):
+        # Copy a cached export into the history, named as a fresh one would be
+        copies = {}
+        for ext, dataset_id in datasets.items():
+            copies[ext] = copy_dataset(gi, hist['id'], dataset_id)
+            copies[ext]['file_ext'] = ext
+            gi.histories.update_dataset(hist['id'], copies[ext]['id'], name='%s.%s' % (organism, ext))
+        return copies
+
+
+class StepTimings(SqliteCache):
+    """How long each workflow step's (and each tool's) jobs took in previous
+    runs, so watchers can guess when a running step will finish."""
+    SCHEMA = """CREATE TABLE IF NOT EXISTS step_timings (
+        job_id TEXT PRIMARY KEY,
+        step TEXT NOT NULL,
+        tool_id TEXT,
+        duration REAL NOT NULL,
+        recorded REAL
+    )"""
+
+    def __init__(self, path=CACHE_DB, samples=20):
+        SqliteCache.__init__(self, path)
+        self.samples = samples
+        # wf_id -> {order index: tool id}
+        self._tools = {}
+
+    def step_key(self, wf_id, step):
+        return '%s:%s' % (wf_id, step['workflow_step_id'])
+
+    def tools(self, gi, wf_id):
+        if wf_id not in self._tools:
+            scheduler.acquire()
+            # show_workflow lists steps by order index, not by the encoded
+            # workflow_step_id invocation steps carry
+            steps = gi.workflows.show_workflow(wf_id)['steps'].values()
+            self._tools[wf_id] = {int(step['id']): step.get('tool_id') for step in steps}
+        return self._tools[wf_id]
+
+    def expected(self, gi, wf_id, step):
+        # Median duration of this step in previous runs, else of its tool
+        rows = self._query('SELECT duration FROM step_timings WHERE step = ? ORDER BY recorded DESC LIMIT ?',
+                           self.step_key(wf_id, step), self.samples)
+        if not rows:
+            tool_id = self.tools(gi, wf_id).get(step.get('order_index'))
+            if tool_id is None:
+                return None
+            rows = self._query('SELECT duration FROM step_timings WHERE tool_id = ? ORDER BY recorded DESC LIMIT ?',
+                               tool_id, self.samples)
+        if not rows:
+            return None
+        durations = sorted(row[0] for row in rows)
+        return durations[len(durations) // 2]
+
+    def record(self, gi, wf_id, step):
+        # The job's own timestamps, so how often we polled doesn't matter
+        try:
+            scheduler.acquire()
+            job = gi.jobs.show_job(step['job_id'])
+            duration = (parse_time(job['update_time']) - parse_time(job['create_time'])).total_seconds()
+        except (ConnectionError, KeyError, ValueError) as e:
+            logging.warning("Could not time job %s: %s", step['job_id'], e)
+            return
+        self._execute('INSERT OR REPLACE INTO step_timings VALUES (?, ?, ?, ?, ?)',
+                      step['job_id'], self.step_key(wf_id, step), job.get('tool_id'), duration, time.time())
+
+
+class RunTimings(SqliteCache):
+    """Wall-clock time of each workflow x organism run in previous builds,
+    from invocation to completion."""
+    SCHEMA = """CREATE TABLE IF NOT EXISTS run_timings (
+        workflow_id TEXT NOT NULL,
+        organism TEXT NOT NULL,
+        duration REAL NOT NULL,
+        recorded REAL
+    )"""
+
+    def __init__(self, path=CACHE_DB, samples=10):
+        SqliteCache.__init__(self, path)
+        self.samples = samples
+
+    def expected(self, wf_id, organism):
+        # Median of the most recent runs, None if there are none
+        rows = self._query('SELECT duration FROM run_timings WHERE workflow_id = ? AND organism = ? '
+                           'ORDER BY recorded DESC LIMIT ?', wf_id, organism, self.samples)
+        if not rows:
+            return None
+        durations = sorted(row[0] for row in rows)
+        return durations[len(durations) // 2]
+
+    def record(self, wf_id, organism, duration):
+        self._execute('INSERT INTO run_timings VALUES (?, ?, ?, ?)', wf_id, organism, duration, time.time())
+
+
+def step_name(timing):
+    # Stable across builds of the same workflow: its position and label
+    return '%s:%s' % (timing['step'], timing['label'] or timing['tool_id'])
+
+
+class RunHistory(SqliteCache):
+    """Durations of every passing workflow x organism run and of each of its
+    steps, kept per build (``build_id``) so later builds can be compared
+    with earlier ones (see compare_runs.py).
+
+    A run's duration is the span of its jobs, from the first created to the
+    last finished, and a step's is its job's runtime where Galaxy measured
+    it, else its whole life; both come from the server, so they don't
+    depend on how the harness polled. Run rows have an empty ``step``.
+    """
+    SCHEMA = """CREATE TABLE IF NOT EXISTS run_history (
+        build_id TEXT NOT NULL,
+        workflow_id TEXT NOT NULL,
+        organism TEXT NOT NULL,
+        step TEXT NOT NULL,
+        duration REAL NOT NULL,
+        recorded REAL
+    )"""
+
+    def __init__(self, path=CACHE_DB, build_id=None):
+        SqliteCache.__init__(self, path)
+        self.build_id = build_id
+
+    def record_run(self, wf_id, organism, timings):
+        # ``timings`` as from metrics.step_timings
+        if not timings:
+            return
+        created = min(parse_time(timing['created']) for timing in timings)
+        finished = max(parse_time(timing['finished']) for timing in timings)
+        rows = [('', (finished - created).total_seconds())]
+        for timing in timings:
+            rows.append((step_name(timing), timing['total'] if timing['running'] is None else timing['running']))
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany('INSERT INTO run_history VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(self.build_id, wf_id, organism or '', step, duration, now)
+                                  for step, duration in rows])
+
+    def latest_build(self):
+        rows = self._query('SELECT build_id FROM run_history ORDER BY recorded DESC LIMIT 1')
+        return rows[0][0] if rows else None
+
+    def build(self, build_id):
+        # {(workflow_id, organism, step): [durations]} recorded by a build,
+        # and when it started recording
+        rows = self._query('SELECT workflow_id, organism, step, duration, recorded FROM run_history '
+                           'WHERE build_id = ?', build_id)
+        series = {}
+        for wf_id, organism, step, duration, recorded in rows:
+            series.setdefault((wf_id, organism, step), []).append(duration)
+        return series, min([row[4] for row in rows] or [None])
+
+    def baseline(self, series, build_id, before, builds=10):
+        # Durations of a series in the ``builds`` most recent other builds
+        # that recorded it before ``before``
+        wf_id, organism, step = series
+        rows = self._query('SELECT build_id, duration FROM run_history WHERE workflow_id = ? AND organism = ? '
+                           'AND step = ? AND build_id != ? AND recorded < ? ORDER BY recorded DESC',
+                           wf_id, organism, step, build_id, before)
+        seen = []
+        durations = []
+        for other, duration in rows:
+            if other not in seen:
+                if len(seen) == builds:
+                    break
+                seen.append(other)
+            durations.append(duration)
+        return durations
+
+
+def dataset_signature(gi, src, dataset_id):
+    # Galaxy's content hashes where it has them, else what changes with the content
+    dataset = gi.datasets.show_dataset(dataset_id, hda_ldda='ldda' if src == 'ldda' else 'hda')
+    if dataset.get('hashes'):
+        return sorted([h['hash_function'], h['hash_value']] for h in dataset['hashes'])
+    return [dataset_id, dataset.get('file_size'), dataset.get('update_time')]
+
+
+class ResultCache(SqliteCache):
+    """Passing workflow test results, keyed on the workflow's content, its
+    inputs' content and the test itself, so an unchanged test need not run
+    again for ``ttl`` seconds."""
+    SCHEMA = """CREATE TABLE IF NOT EXISTS workflow_results (
+        key TEXT PRIMARY KEY,
+        workflow_id TEXT NOT NULL,
+        invocation_id TEXT,
+        elapsed REAL,
+        recorded REAL
+    )"""
+
+    def __init__(self, path=CACHE_DB, ttl=60 * 60 * 24 * 7):
+        SqliteCache.__init__(self, path)
+        self.ttl = ttl
+
+    def key(self, gi, wf_id, test):
+        workflow = gi.workflows.export_workflow_json(wf_id)
+        inputs = {}
+        for step, source in test.get('inputs', {}).items():
+            if isinstance(source, dict) and source.get('src') in ('hda', 'ldda'):
+                inputs[str(step)] = dataset_signature(gi, source['src'], source['id'])
+        digest = hashlib.sha256()
+        digest.update(json.dumps([workflow, inputs, test], sort_keys=True, default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        # (invocation_id, elapsed) of the last pass, if recent enough
+        rows = self._query('SELECT invocation_id, elapsed, recorded FROM workflow_results WHERE key = ?', key)
+        if not rows or (self.ttl is not None and time.time() - rows[0][2] > self.ttl):
+            return None
+        return rows[0][0], rows[0][1]
+
+    def record(self, key, wf_id, invocation_id, elapsed):
+        self._execute('INSERT OR REPLACE INTO workflow_results VALUES (?, ?, ?, ?, ?)',
+                      key, wf_id, invocation_id, elapsed, time.time())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+from cache import StepTimings
+from client import galaxy_instance
+from mock_galaxy import MockGalaxy
+from planning import AdmissionController
+from poller import StatePoller
+from run_comp import ORG_NAMES, WORKFLOW_ID
+from run_matrix import run_batch, split_mapped_results
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Checks of the harness' own logic against a mock galaxy (see
+# mock_galaxy.py), for the paths a real server rarely exercises. Each
+# check_* function raises AssertionError if the harness gets it wrong.
+
+
+def invocation_steps(gi, wf_id, invoke_id, timeout=30):
+    # Tool steps of an invocation, once it has scheduled them
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        invocation = gi.workflows.show_invocation(wf_id, invoke_id)
+        steps = [step for step in invocation.get('steps', []) if step.get('job_id')]
+        if steps:
+            return steps
+        time.sleep(0.1)
+    raise AssertionError("Invocation %s never scheduled" % invoke_id)
+
+
+def check_step_estimate_from_tool(path):
+    # A workflow never run before is estimated from the same tools' jobs in
+    # other workflows
+    with MockGalaxy(job_duration=0.2, queue_time=0.1) as mock:
+        gi = galaxy_instance(mock.url, 'check')
+        timings = StepTimings(path)
+        hist = gi.histories.create_history(name='Check')
+        before, after = mock.add_workflow(), mock.add_workflow()
+        invoke_id = gi.workflows.invoke_workflow(before, history_id=hist['id'])['id']
+        steps = invocation_steps(gi, before, invoke_id)
+        time.sleep(1)
+        for step in steps:
+            timings.record(gi, before, step)
+
+        invoke_id = gi.workflows.invoke_workflow(after, history_id=hist['id'])['id']
+        for step in invocation_steps(gi, after, invoke_id):
+            assert timings._query('SELECT 1 FROM step_timings WHERE step = ?', timings.step_key(after, step)) == []
+            assert timings.expected(gi, after, step) is not None, "No estimate for step %s" % step['order_index']
+
+
+def check_admission_counts_our_jobs(path):
+    # Other users' jobs don't hold our submissions back, on an admin key
+    with MockGalaxy() as mock:
+        gi = galaxy_instance(mock.url, 'check')
+        mock.add_other_jobs(5)
+        admission = AdmissionController(gi, max_jobs=mock.steps + 1)
+        assert admission.active_jobs() == 0, "Counted %s jobs" % admission.active_jobs()
+        hist = gi.histories.create_history(name='Check')
+        wf_id = mock.add_workflow()
+        invoke_id = gi.workflows.invoke_workflow(wf_id, history_id=hist['id'])['id']
+        invocation_steps(gi, wf_id, invoke_id)
+        assert admission.active_jobs() == mock.steps, "Counted %s jobs" % admission.active_jobs()
+
+
+def check_poller_waits_for_step_jobs(path):
+    # Steps listed before their jobs are fetched again until they have them
+    with MockGalaxy(job_duration=0.2, queue_time=0.1, job_delay=2) as mock:
+        gi = galaxy_instance(mock.url, 'check')
+        hist = gi.histories.create_history(name='Check')
+        wf_id = mock.add_workflow()
+        invoke_id = gi.workflows.invoke_workflow(wf_id, history_id=hist['id'])['id']
+        poller = StatePoller(gi, interval=0.2)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            invocation = poller.show_invocation(wf_id, invoke_id)
+            jobs = [step['job_id'] for step in invocation['steps'] if step['job_id']]
+            if len(jobs) == mock.steps:
+                return
+        raise AssertionError("Steps never got their jobs: %s" % invocation['steps'])
+
+
+def check_mapped_batch(path):
+    # A batch galaxy runs as one invocation mapped over the organisms is
+    # split back into a completion suite per organism
+    names = ['Org%s' % i for i in range(3)]
+    with MockGalaxy(job_duration=0.2, queue_time=0.1, map_batches=True) as mock:
+        gi = galaxy_instance(mock.url, 'check')
+        wf = gi.workflows.get_workflows(workflow_id=mock.add_workflow())[0]
+        suites = run_batch(gi, wf, names, 'Check %s', {0: 'fasta', 1: 'json', 2: 'gff3'},
+                           poller=StatePoller(gi, interval=0.2))
+        completed = dict((suite.name, suite) for suite in suites if suite.name.endswith('Workflow Completion'))
+        for name in names:
+            suite = completed.get('[%s] Workflow Completion' % name)
+            assert suite is not None, "No completion suite for %s" % name
+            assert not suite.test_cases[0].is_failure(), "%s failed: %s" % (name, suite.test_cases[0].failure_message)
+
+
+def check_split_waits_for_elements(path):
+    # Elements still queued or running aren't failures, just unfinished
+    names = ['Org%s' % i for i in range(3)]
+    with MockGalaxy(job_duration=0.5, queue_time=0.2, map_batches=True, schedule_delay=0) as mock:
+        gi = galaxy_instance(mock.url, 'check')
+        wf_id = mock.add_workflow(inputs=1)
+        hist = gi.histories.create_history(name='Check')
+        with mock._lock:
+            elements = [{'name': name, 'src': 'hda', 'id': mock._dataset(hist['id'], name, 'fasta')}
+                        for name in names]
+        collection = gi.histories.create_dataset_collection(hist['id'], {
+            'collection_type': 'list', 'name': 'inputs', 'element_identifiers': elements})
+        invocation = gi.workflows._post({
+            'workflow_id': wf_id,
+            'inputs': {'0': {'batch': True, 'product': False, 'values': [{'src': 'hdca', 'id': collection['id']}]}},
+            'history': 'hist_id=%s' % hist['id'],
+            'batch': True,
+        }, url=gi.workflows._invocations_url(wf_id))
+        for suite in split_mapped_results(gi, hist, wf_id, invocation['id'], names):
+            assert not suite.test_cases[0].is_failure(), suite.test_cases[0].failure_message
+        assert mock.finished_at(invocation['id']) is not None, "Split before the elements finished"
+
+
+def check_run_comp(path):
+    # run_comp.py end to end: every organism's data is uploaded, through the
+    # resumable endpoint or the upload tool where there is none, and its run
+    # reported
+    for resumable in (True, False):
+        workdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            for name in ORG_NAMES:
+                for ext in ('fa', 'gff3', 'NT.blastxml', 'NR.blastxml', 'NR.tsv', 'PG.tsv'):
+                    with open(os.path.join(workdir, 'tmp', '%s.%s' % (name, ext)), 'w') as handle:
+                        handle.write('%s %s\n' % (name, ext))
+            report = os.path.join(workdir, 'report.xml')
+            with MockGalaxy(job_duration=0.2, queue_time=0.1, resumable_uploads=resumable) as mock:
+                mock.add_workflow(inputs=5, wf_id=WORKFLOW_ID)
+                run = subprocess.run([
+                    sys.executable, os.path.join(SCRIPT_DIR, 'run_comp.py'), '-u', mock.url, '-k', 'check',
+                    '-x', report, '--cache-db', os.path.join(workdir, 'cache.sqlite'),
+                    '--checkpoint', os.path.join(workdir, 'checkpoint.json'),
+                ], cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=300)
+                patches = mock.calls['PATCH /api/upload/resumable_upload/{id}']
+            assert run.returncode == 0, "run_comp.py exited %s: %s" % (run.returncode, run.stdout[-2000:])
+            totals = ET.parse(report).getroot().attrib
+            assert int(totals['tests']) > 0, "Nothing was reported"
+            assert totals['failures'] == totals['errors'] == '0', "Failed: %s" % totals
+            uploads = len(ORG_NAMES) * 5
+            assert patches == (uploads if resumable else 0), "%s resumable uploads of %s" % (patches, uploads)
+        finally:
+            shutil.rmtree(workdir)
+
+
+def __main__():
+    logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.INFO)
+    logging.getLogger().setLevel(logging.INFO)
+    failed = 0
+    for name, check in sorted(globals().items()):
+        if not name.startswith('check_'):
+            continue
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            check(path)
+            logging.info("OK: %s", name)
+        except AssertionError as e:
+            logging.error("FAIL: %s: %s", name, e)
+            failed += 1
+        finally:
+            os.remove(path)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+import os
+import json
+import threading
+from xunit_wrapper import xunit
+
+
+def default_path(script):
+    # One journal per script, so different pipelines can share a workspace
+    return '.%s.checkpoint.jsonl' % os.path.splitext(os.path.basename(script))[0]
+
+
+class Checkpoint(object):
+    """Append-only journal of what a run has done so far, per workflow x
+    organism key: the history it created, the datasets it loaded, the
+    invocation it submitted and how that finished.
+
+    Each record is a JSON line, flushed and synced as it happens, so a
+    killed run loses at most the line it was writing. With ``resume`` the
+    journal of the previous run is read back and extended; otherwise it is
+    started afresh.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        # key -> {field: value}
+        self._state = {}
+        if resume and os.path.exists(path):
+            with open(path, 'r') as handle:
+                for line in handle:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The torn last line of a killed run
+                        continue
+                    self._state.setdefault(record['key'], {})[record['field']] = record['value']
+        self._handle = open(path, 'a' if resume else 'w')
+        if resume and self._handle.tell():
+            # Don't append onto a torn line
+            self._handle.write('\n')
+
+    def get(self, key):
+        with self._lock:
+            return dict(self._state.get(key, {}))
+
+    def record(self, key, field, value):
+        with self._lock:
+            self._state.setdefault(key, {})[field] = value
+            self._handle.write(json.dumps({'key': key, 'field': field, 'value': value}) + '\n')
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+
+
+def case_result(tc):
+    # What to remember of a finished test case
+    if tc._tc.is_failure():
+        return {'ok': False, 'message': str(tc._tc.failure_message)}
+    return {'ok': True}
+
+
+def resumed_case(classname, result=None):
+    # Stands in for a test case a previous run already finished
+    with xunit('galaxy', classname) as tc:
+        if result is not None and not result['ok']:
+            raise Exception(result['message'])
+    return tc
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import json
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
+from bioblend import ConnectionError
+from bioblend import galaxy
+from tracing import TracedSession
+
+# Enough connections for every watcher, upload and export thread at once
+POOL_SIZE = 64
+# (connect, read) seconds for every request
+TIMEOUT = (10, 300)
+
+
+def make_session(pool_size=POOL_SIZE, retries=3):
+    # One keep-alive connection pool per host, shared by every thread.
+    # Only idempotent requests are retried, on connection errors and 50x;
+    # once retries run out bioblend gets the last 50x response, not a
+    # RetryError. Requests are traced once tracing.tracer is started.
+    session = TracedSession()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class PooledGalaxyInstance(galaxy.GalaxyInstance):
+    """A GalaxyInstance whose requests all go through one pooled, keep-alive
+    ``requests.Session`` with timeouts, rather than bioblend's module level
+    ``requests`` calls, which open a new connection every time.
+
+    The request methods follow bioblend 0.8.0's, with only the transport
+    changed, so they behave the same to the rest of bioblend.
+    """
+
+    def __init__(self, url, key=None, email=None, password=None, session=None, timeout=TIMEOUT):
+        galaxy.GalaxyInstance.__init__(self, url, key, email, password)
+        self.session = session or make_session()
+        self.timeout = timeout
+        self._user_id = None
+
+    def current_user_id(self):
+        # The key's user, to scope listings that an admin key would otherwise
+        # get for every user's jobs
+        if self._user_id is None:
+            self._user_id = self.users.get_current_user()['id']
+        return self._user_id
+
+    def _params(self, params):
+        if params is not None and params.get('key', False) is False:
+            params['key'] = self.key
+        else:
+            params = self.default_params
+        return params
+
+    def make_get_request(self, url, **kwargs):
+        kwargs['params'] = self._params(kwargs.get('params'))
+        kwargs.setdefault('verify', self.verify)
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def make_post_request(self, url, payload, params=None, files_attached=False):
+        params = self._params(params)
+        if files_attached:
+            payload.update(params)
+            payload = MultipartEncoder(fields=payload)
+            headers = self.json_headers.copy()
+            headers['Content-Type'] = payload.content_type
+            post_params = {}
+        else:
+            payload = json.dumps(payload)
+            headers = self.json_headers
+            post_params = params
+
+        r = self.session.post(url, data=payload, headers=headers, verify=self.verify, params=post_params,
+                              timeout=self.timeout)
+        return self._json(r)
+
+    def make_delete_request(self, url, payload=None, params=None):
+        params = self._params(params)
+        if payload is not None:
+            payload = json.dumps(payload)
+        return self.session.delete(url, verify=self.verify, data=payload, params=params, timeout=self.timeout)
+
+    def make_put_request(self, url, payload=None, params=None):
+        params = self._params(params)
+        r = self.session.put(url, verify=self.verify, data=json.dumps(payload), params=params,
+                             timeout=self.timeout)
+        return self._json(r)
+
+    def _json(self, r):
+        if r.status_code == 200:
+            try:
+                return r.json()
+            except Exception as e:
+                raise ConnectionError("Request was successful, but cannot decode the response content: %s" %
+                                      e, body=r.content, status_code=r.status_code)
+        # @see self.body for HTTP response body
+        raise ConnectionError("Unexpected HTTP status code: %s" % r.status_code,
+                              body=r.text, status_code=r.status_code)
+
+
+def galaxy_instance(url, key, pool_size=POOL_SIZE, timeout=TIMEOUT):
+    # The one way the scripts connect to galaxy
+    return PooledGalaxyInstance(url, key, session=make_session(pool_size), timeout=timeout)
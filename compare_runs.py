@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import argparse
+import logging
+from cache import CACHE_DB, RunHistory
+from report import XunitReport
+from xunit_wrapper import xunit, xunit_suite
+
+
+logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.DEBUG)
+# Scales the median absolute deviation to a standard deviation, for normal data
+MAD_SCALE = 1.4826
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def slowdown(current, baseline, min_samples=5, ratio=1.5, min_delta=30, max_score=3.0):
+    # Why ``current`` is significantly slower than ``baseline``, or None if
+    # it isn't. It has to be ``ratio`` times the baseline median, at least
+    # ``min_delta`` seconds more, and, where the baseline varies, more than
+    # ``max_score`` robust standard deviations (scaled MAD) above it.
+    if len(baseline) < min_samples:
+        return None
+    middle = median(baseline)
+    spread = MAD_SCALE * median([abs(duration - middle) for duration in baseline])
+    if current < middle * ratio or current - middle < min_delta:
+        return None
+    if spread and (current - middle) / spread <= max_score:
+        return None
+    message = "%.0fs against a median of %.0fs over %s previous runs" % (current, middle, len(baseline))
+    if spread:
+        message += " (%.1f robust sd)" % ((current - middle) / spread)
+    return message
+
+
+def compare(history, build_id, builds=10, **kwargs):
+    # A test suite per workflow x organism of ``build_id``, with a case per
+    # run and step that fails if it got slower; kwargs go to slowdown()
+    series, started = history.build(build_id)
+    suites = {}
+    for key in sorted(series):
+        wf_id, organism, step = key
+        baseline = history.baseline(key, build_id, started, builds)
+        current = median(series[key])
+        name = 'duration.%s.%s.%s' % (wf_id, organism or 'none', step or 'workflow')
+        with xunit('performance', name) as tc_duration:
+            message = slowdown(current, baseline, **kwargs)
+            if message is not None:
+                raise Exception("Slower: %s" % message)
+        tc_duration._tc.elapsed_sec = current
+        if not baseline:
+            tc_duration._tc.stdout = "no previous runs"
+        elif message is None:
+            tc_duration._tc.stdout = "median of %s previous runs: %.0fs" % (len(baseline), median(baseline))
+        suites.setdefault((wf_id, organism), []).append(tc_duration)
+    return [xunit_suite('[%s:%s] Performance' % (wf_id, organism or 'none'), cases)
+            for (wf_id, organism), cases in sorted(suites.items())]
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="""Compare the durations one build recorded in the run history
+    with those of the builds before it, and report significant slowdowns as xunit failures.""")
+
+    parser.add_argument('-b', '--build', dest="build",
+                        help="""Build to check (the BUILD_NUMBER it ran under), by default the last one recorded""")
+    parser.add_argument('-x', '--xunit-output', dest="xunit_output", default='performance.xml',
+                        help="""Location to store xunit report in""")
+    parser.add_argument('--cache-db', dest="cache_db", default=CACHE_DB,
+                        help="""Local run history the builds recorded""")
+    parser.add_argument('--baseline', dest="builds", type=int, default=10,
+                        help="""Number of previous builds to compare with""")
+    parser.add_argument('--min-samples', dest="min_samples", type=int, default=5,
+                        help="""Fewest previous runs a duration needs before it is judged""")
+    parser.add_argument('--ratio', dest="ratio", type=float, default=1.5,
+                        help="""How many times the baseline median a slowdown must be""")
+    parser.add_argument('--min-delta', dest="min_delta", type=float, default=30,
+                        help="""Fewest seconds over the baseline median a slowdown must be""")
+    parser.add_argument('--max-score', dest="max_score", type=float, default=3.0,
+                        help="""Robust standard deviations over the baseline median a slowdown must be""")
+    args = parser.parse_args()
+
+    history = RunHistory(args.cache_db)
+    build_id = args.build or history.latest_build()
+    if build_id is None:
+        parser.error("No builds in %s" % args.cache_db)
+    logging.info("Comparing build %s with up to %s before it", build_id, args.builds)
+    report = XunitReport(args.xunit_output)
+    try:
+        report.extend(compare(history, build_id, builds=args.builds, min_samples=args.min_samples,
+                              ratio=args.ratio, min_delta=args.min_delta, max_score=args.max_score))
+    finally:
+        report.close()
+
+
+if __name__ == "__main__":
+    __main__()
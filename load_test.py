@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+import argparse
+import os
+import json
+import time
+import yaml
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from client import galaxy_instance
+from metrics import percentile
+from poller import StatePoller, scheduler
+from report import XunitReport
+from tracing import tracer
+from run_matrix import input_mapper
+from run_wf import positive_float, retrieve_and_rename, run_workflow, wait_for_invocation_ready, watch_job_invocation, watch_one
+from xunit_wrapper import xunit, xunit_suite
+
+
+logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.DEBUG)
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("bioblend").setLevel(logging.WARNING)
+NOW = datetime.datetime.now()
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BUILD_ID = os.environ.get('BUILD_NUMBER', 'Manual-%s' % NOW.strftime('%Y.%m.%dT%H:%M'))
+EXPORT_TOOL = 'edu.tamu.cpt2.webapollo.export'
+# Each copy's timings, as in the records and summary
+TIMINGS = ('submit_latency', 'time_to_scheduled', 'time_to_complete')
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="""Load test galaxy the way a class does: submit many
+    copies of a workflow (from a manifest, see testdata/pipelines.yaml) or of the Webapollo export tool,
+    and report percentiles of how long each took to submit, to be scheduled and to complete.""")
+
+    parser.add_argument('-k', '--api-key', '--key', dest='key', metavar='your_api_key',
+                        help='The account linked to this key needs to have admin right to upload by server path',
+                        required=True)
+    parser.add_argument('-u', '--url', dest='url', metavar="http://galaxy_url:port",
+                        help="Be sure to specify the port on which galaxy is running",
+                        default="http://usegalaxy.org")
+    parser.add_argument('-w', "--yaml", "--manifest", dest="yaml", type=argparse.FileType('r'), metavar="Manifest yaml file",
+                        help="Specify a yaml file listing the workflows and their input mappings",
+                        default=os.path.join(SCRIPT_DIR, 'testdata', 'pipelines.yaml'))
+    parser.add_argument('--workflow', dest="workflow",
+                        help="""Id or manifest name of the workflow to submit; without it, the Webapollo export tool is""")
+    parser.add_argument('--organism', dest="organism",
+                        help="""Organism to run on, by default the workflow's first in the manifest""")
+    parser.add_argument('-n', '--copies', dest="copies", type=int, default=23,
+                        help="""Number of copies to submit""")
+    parser.add_argument('--ramp', dest="ramp", type=float, default=1,
+                        help="""Copies to submit per second, 0 for all at once""")
+    parser.add_argument('--concurrency', dest="concurrency", type=int, default=None,
+                        help="""Most copies to have unfinished at once (default: all of them)""")
+    parser.add_argument('--ready-timeout', dest="ready_timeout", type=float, default=600,
+                        help="""Seconds to wait for galaxy to start scheduling each invocation""")
+    parser.add_argument('--max-rps', dest="max_rps", type=positive_float, default=scheduler.rate,
+                        help="""Most polling requests per second to make of galaxy, across all watchers""")
+    parser.add_argument('-x', '--xunit-output', dest="xunit_output", default='load.xml',
+                        help="""Location to store xunit report in, updated as each copy finishes""")
+    parser.add_argument('-o', '--output', dest="output", default='load.json',
+                        help="""Location to store every copy's timings and the summary in""")
+    parser.add_argument('--trace', dest="trace", default=None,
+                        help="""Write a Chrome trace (chrome://tracing, Perfetto) of every galaxy API call to this file""")
+    args = parser.parse_args()
+    if args.trace:
+        tracer.start()
+    scheduler.rate = args.max_rps
+
+    gi = galaxy_instance(args.url, args.key)
+    organism = args.organism
+    if args.workflow is not None:
+        manifest = yaml.safe_load(args.yaml)
+        entry = next((entry for entry in manifest if args.workflow in (entry['id'], entry.get('name'))), None)
+        if entry is None:
+            parser.error("%s is not in the manifest" % args.workflow)
+        organism = organism or entry['organisms'][0]
+        label = entry.get('name', entry['id'])
+    elif organism is None:
+        parser.error("--organism is needed to load test the export tool")
+    else:
+        label = EXPORT_TOOL
+
+    hist = gi.histories.create_history(name='BuildID=%s Load=%s Org=%s Source=Jenkins' % (BUILD_ID, label, organism))
+    gi.histories.create_history_tag(hist['id'], 'Automated')
+    gi.histories.create_history_tag(hist['id'], 'LoadTest')
+    poller = StatePoller(gi)
+    if args.workflow is not None:
+        wf = gi.workflows.get_workflows(workflow_id=entry['id'])[0]
+        # One export for every copy, it isn't part of the load
+        datasets, _ = retrieve_and_rename(gi, hist, organism)
+        inputs = input_mapper(entry['inputs'])(datasets)
+
+        def submit(copy):
+            return submit_workflow(gi, wf, inputs, hist, poller, args.ready_timeout)
+    else:
+        def submit(copy):
+            return submit_export(gi, hist, organism, poller)
+
+    report = XunitReport(args.xunit_output)
+    try:
+        records = run_load(submit, args.copies, ramp=args.ramp, concurrency=args.concurrency, report=report,
+                           label=label)
+        summary = summarize(records)
+        report.add(summary_suite(label, summary))
+    finally:
+        report.close()
+        if args.trace:
+            tracer.dump(args.trace)
+    with open(args.output, 'w') as handle:
+        json.dump({'target': label, 'organism': organism, 'ramp': args.ramp, 'concurrency': args.concurrency,
+                   'summary': summary, 'copies': records}, handle, indent=2, sort_keys=True)
+
+
+def submit_workflow(gi, wf, inputs, hist, poller=None, ready_timeout=600):
+    # One copy through the pipelines' invocation path. Returns (id, submit
+    # latency, time to scheduled, time to complete, test case); the times are
+    # None where it never got that far.
+    started = time.time()
+    wf_test_cases, (wf_id, invoke_id) = run_workflow(gi, wf, inputs, hist)
+    tc_invoke = wf_test_cases[0]
+    submitted = time.time()
+    if tc_invoke._tc.is_failure():
+        return None, None, None, None, tc_invoke
+    invocation = wait_for_invocation_ready(gi, wf_id, invoke_id, deadline=ready_timeout)
+    scheduled = time.time() if invocation['state'] != 'new' or invocation['steps'] else None
+    tc_watch = watch_one(gi, wf_id, invoke_id, poller)
+    return (invoke_id, submitted - started, None if scheduled is None else scheduled - started,
+            time.time() - started, tc_watch)
+
+
+def submit_export(gi, hist, organism, poller=None):
+    # One run of the Webapollo export tool, as retrieve_and_rename runs it;
+    # scheduled once its job starts running
+    started = time.time()
+    with xunit('galaxy', 'launch_tool') as tc_launch, tracer.span('launch_tool', organism=organism):
+        tool_run = gi.tools.run_tool(hist['id'], EXPORT_TOOL, {
+            'org_source|source_select': 'direct',
+            'org_source|org_raw': organism,
+        })
+    submitted = time.time()
+    if tc_launch._tc.is_failure():
+        return None, None, None, None, tc_launch
+    job_id = tool_run['jobs'][0]['id']
+    scheduled = []
+
+    def on_change(state):
+        if not scheduled and state not in ('new', 'queued'):
+            scheduled.append(time.time())
+
+    with xunit('galaxy', 'job_watch.%s' % job_id) as tc_watch:
+        watch_job_invocation(gi, job_id, poller, on_change=on_change)
+    return (job_id, submitted - started, scheduled[0] - started if scheduled else None,
+            time.time() - started, tc_watch)
+
+
+def run_load(submit, copies, ramp=1, concurrency=None, report=None, label='Load'):
+    # Start ``submit(copy)`` for each copy, ``ramp`` per second (0 for all at
+    # once) with at most ``concurrency`` unfinished, and return a record of
+    # each. Each copy's test case goes to ``report`` as it finishes.
+    slots = threading.Semaphore(concurrency or copies)
+    records = [None] * copies
+
+    def run(copy):
+        try:
+            with xunit('galaxy', 'load.copy') as tc_copy:
+                record_id, submit_latency, to_scheduled, to_complete, tc = submit(copy)
+            if tc_copy._tc.is_failure():
+                record_id, submit_latency, to_scheduled, to_complete, tc = None, None, None, None, tc_copy
+            records[copy] = copy_record(copy, started_at[copy], record_id, submit_latency, to_scheduled, to_complete, tc)
+            logging.info("Copy %s (%s) finished %s in %s", copy, record_id,
+                         'ok' if records[copy]['ok'] else 'failed', to_complete)
+            if report is not None:
+                report.add(xunit_suite('[%s] Load copy %s' % (label, copy), [tc]))
+        finally:
+            slots.release()
+
+    started_at = [None] * copies
+    futures = {}
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency or copies) as pool:
+        for copy in range(copies):
+            if ramp:
+                delay = begin + copy / float(ramp) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            started_at[copy] = time.time()
+            futures[pool.submit(run, copy)] = copy
+    # A copy that raised outside its test case still gets a (failed) record,
+    # so the summary counts it
+    for future, copy in futures.items():
+        error = future.exception()
+        if error is None:
+            continue
+        logging.error("Copy %s failed: %s", copy, error)
+        if records[copy] is not None:
+            # Only its report failed
+            continue
+        with xunit('galaxy', 'load.copy') as tc_copy:
+            raise error
+        records[copy] = dict(copy_record(copy, started_at[copy], None, None, None, None, tc_copy), error=str(error))
+        if report is not None:
+            report.add(xunit_suite('[%s] Load copy %s' % (label, copy), [tc_copy]))
+    return records
+
+
+def copy_record(copy, started, record_id, submit_latency, to_scheduled, to_complete, tc):
+    return {
+        'copy': copy,
+        'id': record_id,
+        'started': started,
+        'submit_latency': submit_latency,
+        'time_to_scheduled': to_scheduled,
+        'time_to_complete': to_complete,
+        'ok': not tc._tc.is_failure(),
+    }
+
+
+def summarize(records):
+    # Percentiles of each timing over the copies that got that far, and
+    # completions per minute from the first submission to the last completion
+    summary = {'copies': len(records), 'ok': sum(1 for record in records if record['ok'])}
+    for timing in TIMINGS:
+        values = [record[timing] for record in records if record[timing] is not None]
+        summary[timing] = dict(('p%s' % q, percentile(values, q)) for q in (50, 95, 99))
+        summary[timing]['max'] = max(values) if values else None
+    ends = [record['started'] + record['time_to_complete'] for record in records if record['ok']]
+    begin = min(record['started'] for record in records) if records else None
+    span = max(ends) - begin if ends else None
+    summary['duration'] = span
+    summary['throughput_per_minute'] = len(ends) * 60.0 / span if span else None
+    return summary
+
+
+def describe(summary):
+    parts = ['%(ok)s/%(copies)s ok' % summary]
+    for timing in TIMINGS:
+        parts.append('%s %s' % (timing, ' '.join(
+            '%s=%s' % (q, 'n/a' if summary[timing][q] is None else '%.1fs' % summary[timing][q])
+            for q in ('p50', 'p95', 'p99'))))
+    if summary['throughput_per_minute'] is not None:
+        parts.append('%.2f completions/minute' % summary['throughput_per_minute'])
+    return ', '.join(parts)
+
+
+def summary_suite(label, summary):
+    message = describe(summary)
+    logging.info("Load test of %s: %s", label, message)
+    with xunit('galaxy', 'load.summary') as tc_summary:
+        if summary['ok'] < summary['copies']:
+            raise Exception("%s of %s copies failed" % (summary['copies'] - summary['ok'], summary['copies']))
+    tc_summary._tc.elapsed_sec = summary['duration'] or 0
+    tc_summary._tc.stdout = message
+    return xunit_suite('[%s] Load' % label, [tc_summary])
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import os
+import json
+import math
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bioblend import ConnectionError
+from cache import parse_time
+from poller import scheduler
+from tracing import tracer
+from xunit_wrapper import xunit
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def sidecar_path(report):
+    # Sits next to the xunit report it details
+    return '%s.steps.jsonl' % os.path.splitext(report)[0]
+
+
+def seconds(value):
+    return (parse_time(value) - EPOCH).total_seconds()
+
+
+def number(value):
+    # Galaxy hands job metrics back as strings
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def percentile(values, q):
+    # Nearest rank, None for no values
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(math.ceil(q / 100.0 * len(values))) - 1))]
+
+
+def job_timing(gi, step):
+    # Where a step's job spent its time: from creation to the job starting
+    # on the cluster (queued), its runtime (running), and creation to its
+    # last update (total). The start and runtime come from Galaxy's core job
+    # metrics, so they are missing where those are turned off.
+    scheduler.acquire()
+    job = gi.jobs.show_job(step['job_id'], full_details=True)
+    metrics = dict((metric['name'], number(metric.get('raw_value'))) for metric in job.get('job_metrics', []))
+    created = seconds(job['create_time'])
+    started = metrics.get('start_epoch')
+    running = metrics.get('runtime_seconds')
+    if running is None and started is not None and 'end_epoch' in metrics:
+        running = metrics['end_epoch'] - started
+    return {
+        'step': step.get('order_index'),
+        'label': step.get('workflow_step_label'),
+        'tool_id': job.get('tool_id'),
+        'job_id': step['job_id'],
+        'state': job.get('state'),
+        'created': job['create_time'],
+        'finished': job['update_time'],
+        # Clocks on the cluster and the server can disagree a little
+        'queued': None if started is None else max(started - created, 0),
+        'running': running,
+        'total': seconds(job['update_time']) - created,
+        'metrics': metrics,
+    }
+
+
+def step_timings(gi, wf_id, invoke_id, max_workers=4):
+    # Timings of every job an invocation ran, in step order
+    try:
+        scheduler.acquire()
+        steps = gi.workflows.show_invocation(wf_id, invoke_id)['steps']
+    except ConnectionError as e:
+        logging.warning("Could not list the jobs of invocation %s: %s", invoke_id, e)
+        return []
+
+    def fetch(step):
+        try:
+            return job_timing(gi, step)
+        except (ConnectionError, KeyError, ValueError) as e:
+            logging.warning("Could not time job %s: %s", step['job_id'], e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        timings = pool.map(fetch, [step for step in steps if step.get('job_id')])
+        return [timing for timing in timings if timing is not None]
+
+
+def describe(timing):
+    parts = []
+    for key in ('queued', 'running'):
+        if timing[key] is not None:
+            parts.append('%s %.0fs' % (key, timing[key]))
+    if 'galaxy_slots' in timing['metrics']:
+        parts.append('%s cores' % timing['metrics']['galaxy_slots'])
+    if 'galaxy_memory_mb' in timing['metrics']:
+        parts.append('%s MB' % timing['metrics']['galaxy_memory_mb'])
+    return ', '.join(parts)
+
+
+def step_cases(wf_id, invoke_id, timings):
+    # One test case per job, timed by its runtime where Galaxy measured it
+    cases = []
+    for timing in timings:
+        with xunit(timing['tool_id'] or 'galaxy', 'workflow_step.%s.%s.%s' % (wf_id, invoke_id, timing['step'])) as tc_step:
+            if timing['state'] == 'error':
+                raise Exception("Job %s failed" % timing['job_id'])
+        tc_step._tc.elapsed_sec = timing['running'] if timing['running'] is not None else timing['total']
+        tc_step._tc.stdout = describe(timing)
+        cases.append(tc_step)
+    return cases
+
+
+class StepMetrics(object):
+    """Per-job timings and Galaxy job metrics of finished invocations, for
+    the xunit report and, as one JSON line per job, for a sidecar file at
+    ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._handle = open(path, 'w')
+
+    def add(self, wf_id, invoke_id, timings, **extra):
+        # ``extra`` (e.g. the organism) goes into every line of the sidecar
+        with self._lock:
+            for timing in timings:
+                record = dict(timing, workflow_id=wf_id, invocation_id=invoke_id, **extra)
+                self._handle.write(json.dumps(record, sort_keys=True) + '\n')
+            self._handle.flush()
+        return step_cases(wf_id, invoke_id, timings)
+
+    def close(self):
+        with self._lock:
+            self._handle.close()
+
+
+def completion_cases(gi, wf_id, invoke_id, tc_watch, organism, step_metrics=None, history=None):
+    # The test cases of a finished invocation: its watch, and a case per job
+    # with ``step_metrics`` (a StepMetrics). A passing run's durations go to
+    # ``history`` (a cache.RunHistory).
+    cases = [tc_watch]
+    if step_metrics is None and history is None:
+        return cases
+    with tracer.span('step_metrics', invocation=invoke_id):
+        timings = step_timings(gi, wf_id, invoke_id)
+    if step_metrics is not None:
+        cases.extend(step_metrics.add(wf_id, invoke_id, timings, organism=organism))
+    if history is not None and not tc_watch._tc.is_failure():
+        history.record_run(wf_id, organism, timings)
+    return cases
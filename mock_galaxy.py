@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import datetime
+import itertools
+import threading
+from collections import Counter
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+EPOCH = datetime.datetime(1970, 1, 1)
+TERMINAL_JOB_STATES = ('ok', 'error', 'deleted')
+# What the Webapollo export tool makes, as (file_ext, data_type)
+EXPORT_OUTPUTS = (
+    ('fasta', 'galaxy.datatypes.sequence.Fasta'),
+    ('json', 'galaxy.datatypes.text.Json'),
+    ('gff3', 'galaxy.datatypes.interval.Gff3'),
+)
+
+
+def timestamp(epoch):
+    # Galaxy's naive UTC timestamps
+    return (EPOCH + datetime.timedelta(seconds=epoch)).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+class MockGalaxy(object):
+    """A local stand-in for the parts of the Galaxy API the scripts use:
+    histories and their tags and contents, datasets, resumable (TUS)
+    uploads, tools (``run_tool`` and ``upload_file``), workflows and their invocations, invocation job
+    summaries and jobs, served from a thread on ``host``:``port`` (0 picks a
+    free port).
+
+    Nothing is computed. Each job waits for the one before it in its
+    workflow, then queues for ``queue_time`` seconds and runs for
+    ``job_duration`` seconds, each spread by up to ``jitter`` of itself,
+    and fails with probability ``failure_rate``; jobs after a failed one
+    stay paused. Invocations are scheduled ``schedule_delay`` seconds after
+    they are made, and list their tool steps without a job for a further
+    ``job_delay`` seconds. Batch requests make one invocation per element,
+    or with ``map_batches`` a single invocation mapped over the elements,
+    with an output collection holding each element's last dataset. Every
+    response is delayed by ``latency`` seconds (plus up
+    to ``latency_jitter``), and answered with a 503 with probability
+    ``error_rate``. Workflows have ``inputs`` input steps followed by
+    ``steps`` tool steps. Without ``resumable_uploads`` there is no TUS
+    endpoint, as on servers that only take uploads through the tool.
+
+    ``calls`` counts the requests served by route, e.g.
+    ``'GET /api/jobs/{id}'``.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, job_duration=2.0, queue_time=0.5, jitter=0.5,
+                 failure_rate=0.0, schedule_delay=0.5, job_delay=0.0, latency=0.0, latency_jitter=0.0,
+                 error_rate=0.0, inputs=3, steps=3, map_batches=False, resumable_uploads=True, seed=None):
+        self.job_duration = job_duration
+        self.queue_time = queue_time
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.schedule_delay = schedule_delay
+        self.job_delay = job_delay
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.inputs = inputs
+        self.steps = steps
+        self.map_batches = map_batches
+        self.resumable_uploads = resumable_uploads
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self._lock = threading.RLock()
+        # Ids are unique to each server, so process-wide caches never mix them up
+        self._ids = itertools.count(self.random.randint(1, 1 << 24) << 24)
+        # The key's user; the key is an admin's, so job listings without a
+        # user_id cover every user
+        self.user_id = self._id()
+        self.histories = {}
+        self.datasets = {}
+        self.collections = {}
+        self.jobs = {}
+        self.workflows = {}
+        self.invocations = {}
+        # Resumable upload id -> bytes received so far
+        self.uploads = {}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def api_calls(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    # Simulation
+
+    def _id(self):
+        return '%016x' % next(self._ids)
+
+    def _spread(self, value):
+        return max(value * (1 + self.random.uniform(-self.jitter, self.jitter)), 0)
+
+    def add_workflow(self, name=None, inputs=None, steps=None, wf_id=None):
+        with self._lock:
+            wf_id = wf_id or self._id()
+            inputs = self.inputs if inputs is None else inputs
+            steps = self.steps if steps is None else steps
+            self.workflows[wf_id] = {
+                'id': wf_id,
+                'name': name or 'Mock workflow %s' % wf_id,
+                'inputs': inputs,
+                'steps': steps,
+                # Encoded ids, as invocation steps' workflow_step_id
+                'step_ids': [self._id() for _ in range(inputs + steps)],
+            }
+            return wf_id
+
+    def _job(self, tool_id, history_id, after=None, created=None, user_id=None):
+        job_id = self._id()
+        self.jobs[job_id] = {
+            'id': job_id,
+            'tool_id': tool_id,
+            'history_id': history_id,
+            'user_id': user_id or self.user_id,
+            'after': after,
+            'created': time.time() if created is None else created,
+            'queue': self._spread(self.queue_time),
+            'run': self._spread(self.job_duration),
+            'fails': self.random.random() < self.failure_rate,
+        }
+        return job_id
+
+    def add_other_jobs(self, count, duration=3600):
+        # Jobs of another user, running for ``duration`` seconds
+        with self._lock:
+            user_id = self._id()
+            jobs = [self._job('other_tool', None, user_id=user_id) for _ in range(count)]
+            for job_id in jobs:
+                self.jobs[job_id].update(queue=0, run=duration, fails=False)
+            return jobs
+
+    def _dataset(self, history_id, name, ext, job_id=None, data_type=None):
+        dataset_id = self._id()
+        self.datasets[dataset_id] = {
+            'id': dataset_id,
+            'name': name,
+            'history_id': history_id,
+            'file_ext': ext,
+            'data_type': data_type or 'galaxy.datatypes.data.Data',
+            'job_id': job_id,
+            'file_size': self.random.randint(1, 1 << 20),
+            'created': time.time(),
+        }
+        return dataset_id
+
+    def _ready(self, job_id):
+        # When the job can start queueing, None while it is held back by a
+        # job that failed or hasn't finished
+        job = self.jobs[job_id]
+        if job['after'] is None:
+            return job['created']
+        before = self.jobs[job['after']]
+        ended = self._ended(job['after'])
+        if ended is None or before['fails']:
+            return None
+        return max(ended, job['created'])
+
+    def _ended(self, job_id):
+        ready = self._ready(job_id)
+        if ready is None:
+            return None
+        job = self.jobs[job_id]
+        return ready + job['queue'] + job['run']
+
+    def _state(self, job_id, now=None):
+        now = time.time() if now is None else now
+        job = self.jobs[job_id]
+        ready = self._ready(job_id)
+        if ready is None:
+            if self._state(job['after'], now) in ('error', 'paused'):
+                return 'paused'
+            return 'new'
+        if now < ready:
+            return 'new'
+        if now < ready + job['queue']:
+            return 'queued'
+        if now < ready + job['queue'] + job['run']:
+            return 'running'
+        return 'error' if job['fails'] else 'ok'
+
+    def _updated(self, job_id, now=None):
+        # When the job last changed state
+        now = time.time() if now is None else now
+        job = self.jobs[job_id]
+        ready = self._ready(job_id)
+        if ready is None:
+            return job['created']
+        changes = [job['created'], ready, ready + job['queue'], ready + job['queue'] + job['run']]
+        return max(change for change in changes if change <= now)
+
+    def _schedule(self, invocation):
+        # Jobs appear once the invocation is scheduled, a chain of them per
+        # element for a mapped-over invocation
+        if invocation['jobs'] is None and time.time() >= invocation['created'] + self.schedule_delay:
+            created = invocation['created'] + self.schedule_delay
+            workflow = self.workflows[invocation['workflow_id']]
+            jobs = []
+            outputs = []
+            for element in invocation['elements'] or [None]:
+                chain = []
+                for step in range(workflow['steps']):
+                    chain.append(self._job('mock_tool_%s' % step, invocation['history_id'],
+                                           after=chain[-1] if chain else None, created=created))
+                jobs.extend(chain)
+                if element is not None and chain:
+                    dataset_id = self._dataset(invocation['history_id'], element, 'data', chain[-1])
+                    outputs.append({'element_identifier': element, 'id': dataset_id})
+            if invocation['elements'] is not None:
+                collection_id = self._id()
+                self.collections[collection_id] = {'id': collection_id, 'name': 'output', 'collection_type': 'list',
+                                                   'elements': outputs}
+                invocation['output_collections'] = {'output': {'id': collection_id, 'src': 'hdca'}}
+            invocation['jobs'] = jobs
+
+    def finished_at(self, invoke_id):
+        # When the invocation's last job finished, None while any is unfinished
+        with self._lock:
+            invocation = self.invocations[invoke_id]
+            self._schedule(invocation)
+            if invocation['jobs'] is None:
+                return None
+            states = [self._state(job_id) for job_id in invocation['jobs']]
+            if any(state not in TERMINAL_JOB_STATES + ('paused',) for state in states):
+                return None
+            if not invocation['jobs']:
+                # Nothing to run, so done once scheduled
+                return invocation['created'] + self.schedule_delay
+            return max(self._updated(job_id) for job_id in invocation['jobs'])
+
+    # Documents
+
+    def _job_doc(self, job_id, full=False):
+        job = self.jobs[job_id]
+        now = time.time()
+        state = self._state(job_id, now)
+        doc = {
+            'id': job_id,
+            'tool_id': job['tool_id'],
+            'history_id': job['history_id'],
+            'state': state,
+            'create_time': timestamp(job['created']),
+            'update_time': timestamp(self._updated(job_id, now)),
+        }
+        if full:
+            metrics = []
+            if state in ('ok', 'error'):
+                ready = self._ready(job_id)
+                started = ready + job['queue']
+                metrics = [
+                    {'name': 'start_epoch', 'raw_value': str(started), 'plugin': 'core'},
+                    {'name': 'end_epoch', 'raw_value': str(started + job['run']), 'plugin': 'core'},
+                    {'name': 'runtime_seconds', 'raw_value': str(job['run']), 'plugin': 'core'},
+                    {'name': 'galaxy_slots', 'raw_value': '1', 'plugin': 'core'},
+                    {'name': 'galaxy_memory_mb', 'raw_value': '2048', 'plugin': 'core'},
+                ]
+            doc['job_metrics'] = metrics
+        return doc
+
+    def _dataset_doc(self, dataset_id):
+        dataset = self.datasets[dataset_id]
+        state = 'ok' if dataset['job_id'] is None else self._state(dataset['job_id'])
+        return {
+            'id': dataset_id,
+            'name': dataset['name'],
+            'history_id': dataset['history_id'],
+            'file_ext': dataset['file_ext'],
+            'data_type': dataset['data_type'],
+            'file_size': dataset['file_size'],
+            'state': state,
+            'deleted': False,
+            'purged': False,
+            'hashes': [],
+            'create_time': timestamp(dataset['created']),
+            'update_time': timestamp(dataset['created']),
+        }
+
+    def _invocation_doc(self, invoke_id, steps=True):
+        invocation = self.invocations[invoke_id]
+        self._schedule(invocation)
+        doc = {
+            'id': invoke_id,
+            'workflow_id': invocation['workflow_id'],
+            'history_id': invocation['history_id'],
+            'state': 'new' if invocation['jobs'] is None else 'scheduled',
+            'create_time': timestamp(invocation['created']),
+            'update_time': timestamp(invocation['created'] + (0 if invocation['jobs'] is None else self.schedule_delay)),
+        }
+        if invocation['jobs'] is not None:
+            doc['output_collections'] = invocation.get('output_collections', {})
+        if steps:
+            workflow = self.workflows[invocation['workflow_id']]
+            doc['steps'] = []
+            if invocation['jobs'] is not None:
+                for index in range(workflow['inputs']):
+                    doc['steps'].append({'id': self._id(), 'order_index': index,
+                                         'workflow_step_id': workflow['step_ids'][index],
+                                         'workflow_step_label': 'input %s' % index, 'job_id': None, 'state': None})
+                listed = time.time() >= invocation['created'] + self.schedule_delay + self.job_delay
+                if invocation['elements'] is not None:
+                    # Mapped-over steps have many jobs, so no job or state of their own
+                    for index in range(workflow['steps']):
+                        order_index = workflow['inputs'] + index
+                        doc['steps'].append({'id': self._id(), 'order_index': order_index,
+                                             'workflow_step_id': workflow['step_ids'][order_index],
+                                             'workflow_step_label': None, 'job_id': None, 'state': None})
+                    return doc
+                for index, job_id in enumerate(invocation['jobs']):
+                    order_index = workflow['inputs'] + index
+                    doc['steps'].append({'id': job_id, 'order_index': order_index,
+                                         'workflow_step_id': workflow['step_ids'][order_index],
+                                         'workflow_step_label': None,
+                                         'job_id': job_id if listed else None,
+                                         'state': self._state(job_id) if listed else 'new'})
+        return doc
+
+    def _workflow_doc(self, wf_id):
+        workflow = self.workflows[wf_id]
+        inputs = dict((str(index), {'label': 'input %s' % index, 'value': ''}) for index in range(workflow['inputs']))
+        steps = {}
+        for index in range(workflow['inputs'] + workflow['steps']):
+            tool = index >= workflow['inputs']
+            steps[str(index)] = {
+                'id': index,
+                'type': 'tool' if tool else 'data_input',
+                'tool_id': 'mock_tool_%s' % (index - workflow['inputs']) if tool else None,
+            }
+        return {'id': wf_id, 'name': workflow['name'], 'url': '/api/workflows/%s' % wf_id,
+                'inputs': inputs, 'steps': steps}
+
+    # Handlers, each (params, payload, *url groups) -> (status, document),
+    # or (status, document, headers)
+
+    def create_history(self, params, payload):
+        history_id = self._id()
+        self.histories[history_id] = {'id': history_id, 'name': payload.get('name', 'Unnamed history'), 'tags': []}
+        return 200, dict(self.histories[history_id])
+
+    def create_history_tag(self, params, payload, history_id, tag):
+        self.histories[history_id]['tags'].append(tag)
+        return 200, {'model_class': 'HistoryTagAssociation', 'user_tname': tag, 'user_value': None}
+
+    def create_history_contents(self, params, payload, history_id):
+        if payload.get('type') == 'dataset_collection':
+            collection_id = self._id()
+            self.collections[collection_id] = {
+                'id': collection_id,
+                'name': payload.get('name'),
+                'collection_type': payload.get('collection_type', 'list'),
+                'elements': [{'element_identifier': element['name'], 'id': element['id']}
+                             for element in payload.get('element_identifiers', [])],
+            }
+            return 200, self._collection_doc(collection_id)
+        # A copy of an existing dataset
+        source = self.datasets[payload['content']]
+        dataset_id = self._dataset(history_id, source['name'], source['file_ext'], source['job_id'],
+                                   source['data_type'])
+        return 200, self._dataset_doc(dataset_id)
+
+    def show_history_contents(self, params, payload, history_id):
+        if history_id not in self.histories:
+            return 404, {'err_msg': 'No such history: %s' % history_id}
+        return 200, [dict(self._dataset_doc(dataset_id), type='file', history_content_type='dataset', visible=True)
+                     for dataset_id, dataset in self.datasets.items() if dataset['history_id'] == history_id]
+
+    def _collection_doc(self, collection_id):
+        collection = self.collections[collection_id]
+        return {
+            'id': collection_id,
+            'name': collection['name'],
+            'collection_type': collection['collection_type'],
+            'elements': [{'element_identifier': element['element_identifier'],
+                          'object': self._dataset_doc(element['id'])}
+                         for element in collection['elements']],
+        }
+
+    def show_dataset_collection(self, params, payload, history_id, collection_id):
+        return 200, self._collection_doc(collection_id)
+
+    def update_history_dataset(self, params, payload, history_id, dataset_id):
+        if 'name' in payload:
+            self.datasets[dataset_id]['name'] = payload['name']
+        return 200, self._dataset_doc(dataset_id)
+
+    def show_dataset(self, params, payload, dataset_id):
+        return 200, self._dataset_doc(dataset_id)
+
+    def create_upload(self, params, payload):
+        if not self.resumable_uploads:
+            return 404, {'err_msg': 'No resumable uploads'}
+        upload_id = self._id()
+        self.uploads[upload_id] = 0
+        return 201, None, {'Location': '/api/upload/resumable_upload/%s' % upload_id}
+
+    def show_upload(self, params, payload, upload_id):
+        return 200, None, {'Upload-Offset': str(self.uploads[upload_id])}
+
+    def append_upload(self, params, payload, upload_id):
+        self.uploads[upload_id] += len(payload.get('data', b''))
+        return 204, None, {'Upload-Offset': str(self.uploads[upload_id])}
+
+    def run_tool(self, params, payload):
+        history_id = payload['history_id']
+        inputs = payload.get('inputs', {})
+        if isinstance(inputs, str):
+            inputs = json.loads(inputs)
+        job_id = self._job(payload['tool_id'], history_id)
+        if payload['tool_id'] == 'upload1':
+            file_data = inputs.get('files_0|file_data')
+            if isinstance(file_data, dict):
+                # A finished resumable upload
+                self.uploads.pop(file_data['session_id'])
+            name = inputs.get('files_0|NAME') or 'upload'
+            outputs = [(name, inputs.get('file_type', 'auto'), None)]
+        elif payload['tool_id'] == 'edu.tamu.cpt2.webapollo.export':
+            outputs = [('%s.%s' % (payload['tool_id'], ext), ext, data_type) for ext, data_type in EXPORT_OUTPUTS]
+        else:
+            outputs = [('%s output' % payload['tool_id'], 'data', None)]
+        datasets = [self._dataset(history_id, name, ext, job_id, data_type) for name, ext, data_type in outputs]
+        return 200, {
+            'outputs': [self._dataset_doc(dataset_id) for dataset_id in datasets],
+            'output_collections': [],
+            'jobs': [self._job_doc(job_id)],
+        }
+
+    def get_workflows(self, params, payload):
+        return 200, [{'id': wf_id, 'name': workflow['name'], 'url': '/api/workflows/%s' % wf_id}
+                     for wf_id, workflow in self.workflows.items()]
+
+    def show_workflow(self, params, payload, wf_id):
+        return 200, self._workflow_doc(wf_id)
+
+    def export_workflow(self, params, payload, wf_id):
+        doc = self._workflow_doc(wf_id)
+        return 200, {'name': doc['name'], 'steps': doc['steps']}
+
+    def invoke_workflow(self, params, payload, wf_id):
+        history = payload.get('history', '')
+        if history.startswith('hist_id='):
+            history_id = history[len('hist_id='):]
+        else:
+            history_id = self.create_history({}, {'name': history})[1]['id']
+        elements = None
+        if payload.get('batch'):
+            # One invocation per element of the (linked) batch collections
+            for source in payload.get('inputs', {}).values():
+                if isinstance(source, dict) and source.get('batch'):
+                    elements = [element['element_identifier']
+                                for element in self.collections[source['values'][0]['id']]['elements']]
+                    break
+        invocations = []
+        for _ in range(1 if elements is None or self.map_batches else len(elements)):
+            invoke_id = self._id()
+            self.invocations[invoke_id] = {'id': invoke_id, 'workflow_id': wf_id, 'history_id': history_id,
+                                           'created': time.time(), 'jobs': None,
+                                           'elements': elements if self.map_batches else None}
+            invocations.append(self._invocation_doc(invoke_id))
+        return 200, invocations if elements is not None and not self.map_batches else invocations[0]
+
+    def get_invocations(self, params, payload, wf_id):
+        return 200, [self._invocation_doc(invoke_id, steps=False)
+                     for invoke_id, invocation in self.invocations.items() if invocation['workflow_id'] == wf_id]
+
+    def show_invocation(self, params, payload, wf_id, invoke_id):
+        return 200, self._invocation_doc(invoke_id)
+
+    def invocation_jobs_summary(self, params, payload, invoke_id):
+        invocation = self.invocations[invoke_id]
+        self._schedule(invocation)
+        states = Counter(self._state(job_id) for job_id in invocation['jobs'] or [])
+        return 200, {'id': invoke_id, 'model': 'WorkflowInvocation', 'states': dict(states)}
+
+    def get_jobs(self, params, payload):
+        states = params.get('state')
+        limit = int(params.get('limit', [500])[0])
+        user_id = params.get('user_id', [None])[0]
+        jobs = [self._job_doc(job_id) for job_id, job in self.jobs.items()
+                if user_id is None or job['user_id'] == user_id]
+        if states:
+            jobs = [job for job in jobs if job['state'] in states]
+        # Most recently updated first, as galaxy lists them
+        jobs.sort(key=lambda job: job['update_time'], reverse=True)
+        return 200, jobs[:limit]
+
+    def current_user(self, params, payload):
+        return 200, {'id': self.user_id, 'username': 'mock', 'email': 'mock@example.org', 'is_admin': True}
+
+    def show_job(self, params, payload, job_id):
+        full = params.get('full', ['False'])[0] in ('True', 'true', '1')
+        return 200, self._job_doc(job_id, full=full)
+
+    ROUTES = (
+        ('POST', r'/api/histories', 'create_history'),
+        ('POST', r'/api/histories/(\w+)/tags/([^/]+)', 'create_history_tag'),
+        ('POST', r'/api/histories/(\w+)/contents', 'create_history_contents'),
+        ('GET', r'/api/histories/(\w+)/contents', 'show_history_contents'),
+        ('GET', r'/api/histories/(\w+)/contents/dataset_collections/(\w+)', 'show_dataset_collection'),
+        ('PUT', r'/api/histories/(\w+)/contents/(\w+)', 'update_history_dataset'),
+        ('GET', r'/api/datasets/(\w+)', 'show_dataset'),
+        ('POST', r'/api/upload/resumable_upload', 'create_upload'),
+        ('HEAD', r'/api/upload/resumable_upload/(\w+)', 'show_upload'),
+        ('PATCH', r'/api/upload/resumable_upload/(\w+)', 'append_upload'),
+        ('POST', r'/api/tools', 'run_tool'),
+        ('GET', r'/api/workflows', 'get_workflows'),
+        ('GET', r'/api/workflows/download/(\w+)', 'export_workflow'),
+        ('GET', r'/api/workflows/(\w+)', 'show_workflow'),
+        ('POST', r'/api/workflows/(\w+)/invocations', 'invoke_workflow'),
+        ('GET', r'/api/workflows/(\w+)/invocations', 'get_invocations'),
+        ('GET', r'/api/workflows/(\w+)/invocations/(\w+)', 'show_invocation'),
+        ('GET', r'/api/invocations/(\w+)/jobs_summary', 'invocation_jobs_summary'),
+        ('GET', r'/api/jobs', 'get_jobs'),
+        ('GET', r'/api/jobs/(\w+)', 'show_job'),
+        ('GET', r'/api/users/current', 'current_user'),
+    )
+
+    def handle(self, method, path, query, content_type, body):
+        # (status, document, headers) for one request
+        for route_method, pattern, name in self.ROUTES:
+            match = re.match(pattern + '$', path.rstrip('/'))
+            if route_method != method or match is None:
+                continue
+            with self._lock:
+                self.calls['%s %s' % (method, re.sub(r'\(.*?\)', '{id}', pattern))] += 1
+            if self.random.random() < self.error_rate:
+                return 503, {'err_msg': 'Mock server error'}, {}
+            payload = self._payload(content_type, body)
+            try:
+                with self._lock:
+                    response = getattr(self, name)(parse_qs(query), payload, *match.groups())
+            except KeyError as e:
+                return 404, {'err_msg': 'No such object: %s' % e}, {}
+            return response if len(response) == 3 else response + ({},)
+        with self._lock:
+            self.calls['%s unknown' % method] += 1
+        return 404, {'err_msg': 'No route for %s %s' % (method, path)}, {}
+
+    def _payload(self, content_type, body):
+        if not body:
+            return {}
+        if content_type.startswith('application/offset+octet-stream'):
+            return {'data': body}
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode('utf-8') + b'\r\n\r\n' + body)
+            payload = {}
+            for part in message.get_payload():
+                if part.get_filename() is None:
+                    payload[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode('utf-8')
+            return payload
+        return json.loads(body.decode('utf-8'))
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, as the client pools its connections
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self):
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if mock.latency or mock.latency_jitter:
+                    time.sleep(mock.latency + mock.random.uniform(0, mock.latency_jitter))
+                status, document, headers = mock.handle(self.command, url.path, url.query,
+                                                        self.headers.get('Content-Type', ''), body)
+                data = b'' if document is None else json.dumps(document).encode('utf-8')
+                self.send_response(status)
+                for header, value in sorted(headers.items()):
+                    self.send_header(header, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+
+            do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _respond
+
+            def log_message(self, format, *args):
+                logging.debug("%s %s", self.address_string(), format % args)
+
+        return Handler
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="""Serve a fake Galaxy API, to run the scripts against
+    without a real server (e.g. run_wf.py -u http://127.0.0.1:8080 -k any).""")
+
+    parser.add_argument('--host', dest="host", default='127.0.0.1')
+    parser.add_argument('--port', dest="port", type=int, default=8080)
+    parser.add_argument('--job-duration', dest="job_duration", type=float, default=2.0,
+                        help="""Seconds each job runs for""")
+    parser.add_argument('--queue-time', dest="queue_time", type=float, default=0.5,
+                        help="""Seconds each job queues for""")
+    parser.add_argument('--jitter', dest="jitter", type=float, default=0.5,
+                        help="""Fraction by which job times vary""")
+    parser.add_argument('--failure-rate', dest="failure_rate", type=float, default=0.0,
+                        help="""Fraction of jobs that fail""")
+    parser.add_argument('--latency', dest="latency", type=float, default=0.0,
+                        help="""Seconds every response is delayed by""")
+    parser.add_argument('--error-rate', dest="error_rate", type=float, default=0.0,
+                        help="""Fraction of requests answered with a 503""")
+    parser.add_argument('--map-batches', dest="map_batches", action="store_true", default=False,
+                        help="""Run batch requests as one invocation mapped over the elements""")
+    parser.add_argument('--no-resumable-uploads', dest="resumable_uploads", action="store_false", default=True,
+                        help="""Serve no TUS endpoint, so uploads go through the upload tool""")
+    parser.add_argument('--workflow', dest="workflows", action='append', default=[],
+                        help="""Id of a workflow to serve, e.g. one the script runs; may be repeated""")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.INFO)
+    mock = MockGalaxy(args.host, args.port, job_duration=args.job_duration, queue_time=args.queue_time,
+                      jitter=args.jitter, failure_rate=args.failure_rate, latency=args.latency,
+                      error_rate=args.error_rate, map_batches=args.map_batches,
+                      resumable_uploads=args.resumable_uploads)
+    for wf_id in args.workflows:
+        mock.add_workflow(wf_id=wf_id)
+    logging.info("Serving a mock galaxy at %s", mock.url)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("Served %s requests: %s", mock.api_calls(), dict(mock.calls))
+        mock.server.server_close()
+
+
+if __name__ == "__main__":
+    __main__()
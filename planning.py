@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+import time
+import heapq
+import logging
+import itertools
+import threading
+from bioblend import ConnectionError
+from poller import scheduler
+from xunit_wrapper import xunit, xunit_suite
+
+# Jobs in these states are the load our submissions put on the server
+ACTIVE_JOB_STATES = ('new', 'queued', 'running')
+
+
+class PrioritySlots(object):
+    """A counting semaphore that hands each free slot to the waiter with the
+    lowest ``priority`` value, rather than to whoever has waited longest."""
+
+    def __init__(self, value):
+        self._cond = threading.Condition()
+        self._free = value
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def acquire(self, priority=0):
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] != entry or not self._free:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._free -= 1
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._free += 1
+            self._cond.notify_all()
+
+
+class AdmissionController(object):
+    """Hold new submissions back while the server is busy with our work.
+
+    ``admit`` blocks until we have fewer than ``max_jobs`` jobs new, queued or
+    running on the server and fewer than ``max_inflight`` submissions of
+    our own not yet ``done``; either ceiling may be left out. Submissions are
+    admitted one at a time, each against a fresh job count.
+    """
+
+    def __init__(self, gi, max_jobs=None, max_inflight=None, interval=10):
+        self.gi = gi
+        self.max_jobs = max_jobs
+        self.max_inflight = max_inflight
+        self.interval = interval
+        self.inflight = 0
+        self._cond = threading.Condition()
+        self._admitting = threading.Lock()
+
+    def admit(self):
+        # One caller at a time counts and is admitted, so each count is
+        # fresh, but done() isn't held up behind the request
+        with self._admitting:
+            while True:
+                with self._cond:
+                    while self.max_inflight is not None and self.inflight >= self.max_inflight:
+                        self._cond.wait(self.interval)
+                jobs = self.active_jobs()
+                if jobs is None or jobs < self.max_jobs:
+                    break
+                logging.info("At least %s of our jobs are active on the server, holding submissions", jobs)
+                with self._cond:
+                    self._cond.wait(self.interval)
+            with self._cond:
+                self.inflight += 1
+
+    def done(self):
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    def active_jobs(self):
+        # None when there is no job ceiling, or the server can't tell us.
+        # Counts stop at the ceiling, which is all admit() needs to know.
+        if self.max_jobs is None:
+            return None
+        try:
+            scheduler.acquire()
+            user_id = self.gi.current_user_id()
+            scheduler.acquire()
+            # bioblend 0.8's get_jobs takes no filters, and an admin key
+            # lists every user's jobs without user_id
+            jobs = self.gi.jobs._get(params={'state': list(ACTIVE_JOB_STATES), 'user_id': user_id,
+                                             'limit': self.max_jobs})
+        except ConnectionError as e:
+            logging.warning("Could not count our jobs, submitting anyway: %s", e)
+            return None
+        return len(jobs)
+
+
+def predict_makespan(durations, workers=None):
+    # Greedy list scheduling: each run, in order, starts on whichever worker
+    # frees up first
+    if not durations:
+        return 0
+    if not workers or workers >= len(durations):
+        return max(durations)
+    finishes = [0] * workers
+    for duration in durations:
+        heapq.heappush(finishes, heapq.heappop(finishes) + duration)
+    return max(finishes)
+
+
+class Plan(object):
+    """Submission order for a set of workflow x organism runs, longest
+    expected first, from the wall-clock times in ``run_timings`` (a
+    :class:`cache.RunTimings`), and the predicted vs actual makespan.
+
+    Runs with no history go first, as they may well be the longest.
+    """
+
+    def __init__(self, run_timings, workers=None):
+        self.run_timings = run_timings
+        self.workers = workers
+        self._lock = threading.Lock()
+        # (wf_id, organism) -> expected seconds, or None if never seen
+        self.expected = {}
+        self.started = None
+        self.finished = None
+
+    def order(self, wf_id, org_names):
+        for name in org_names:
+            if (wf_id, name) not in self.expected:
+                self.expected[(wf_id, name)] = self.run_timings.expected(wf_id, name)
+        return sorted(org_names, key=lambda name: self.priority(wf_id, name))
+
+    def priority(self, wf_id, name):
+        expected = self.expected.get((wf_id, name))
+        return float('-inf') if expected is None else -expected
+
+    def total(self, wf_id, org_names):
+        # Priority of a whole workflow: the sum of its runs
+        return sum(self.priority(wf_id, name) for name in self.order(wf_id, org_names))
+
+    def begin(self):
+        started = time.time()
+        with self._lock:
+            if self.started is None:
+                self.started = started
+        return started
+
+    def end(self, wf_id, name, started, ok=True):
+        finished = time.time()
+        with self._lock:
+            self.finished = max(self.finished or finished, finished)
+        # Failed runs stop early, so their times would mislead the next order
+        if ok:
+            self.run_timings.record(wf_id, name, finished - started)
+
+    def predicted(self):
+        known = [expected for expected in self.expected.values() if expected is not None]
+        if not known:
+            return None
+        # Runs we have never seen are guessed at the average of those we have
+        guess = sum(known) / len(known)
+        durations = sorted([guess if expected is None else expected for expected in self.expected.values()],
+                           reverse=True)
+        return predict_makespan(durations, self.workers)
+
+    def report(self, name):
+        predicted = self.predicted()
+        actual = None if self.finished is None else self.finished - self.started
+        message = "predicted %s, actual %s" % (
+            'unknown' if predicted is None else '%.0fs' % predicted,
+            'unknown' if actual is None else '%.0fs' % actual,
+        )
+        logging.info("Makespan of %s: %s", name, message)
+        with xunit('galaxy', 'makespan') as tc_makespan:
+            pass
+        tc_makespan._tc.stdout = message
+        return xunit_suite('[%s] Makespan' % name, [tc_makespan])
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+import time
+import heapq
+import logging
+import datetime
+import itertools
+import threading
+from justbackoff import Backoff
+from tracing import tracer
+
+TERMINAL_JOB_STATES = ('ok', 'error', 'deleted')
+
+
+class PollScheduler(object):
+    """Decides when every watcher in the process polls next.
+
+    Each watcher (by key) has its own jittered exponential backoff, reset
+    whenever the watcher reports a change. Watchers that can predict their
+    next change sleep until then instead. All requests share a global
+    budget of ``rate`` requests per second; when the budget is short, the
+    watcher with the earliest deadline goes first.
+    """
+
+    def __init__(self, rate=10, min_ms=100, max_ms=1000 * 60 * 5):
+        self.rate = rate
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self._cond = threading.Condition()
+        self._backoffs = {}
+        # (deadline, seq) of requests waiting for budget
+        self._queue = []
+        self._seq = itertools.count()
+        self._tokens = float(rate)
+        self._refilled = time.time()
+
+    def wait(self, key, changed=False, request=True, expected=None, max_delay=None):
+        # Sleep until this watcher's next poll is due and, if it is about to
+        # make the request itself, until the budget allows it. ``expected`` is
+        # how many seconds the watcher thinks are left until something changes;
+        # ``max_delay`` caps the sleep for watchers that must notice promptly.
+        with self._cond:
+            backoff = self._backoffs.get(key)
+            if backoff is None:
+                backoff = self._backoffs[key] = Backoff(min_ms=self.min_ms, max_ms=self.max_ms,
+                                                        factor=2, jitter=True)
+            if changed:
+                backoff.reset()
+            if expected is not None and expected * 1000 > self.min_ms:
+                # Skip the polls that can't see anything new, then start over
+                # from the shortest interval around the expected change
+                backoff.reset()
+                delay = min(expected, self.max_ms / 1000.0)
+            else:
+                delay = backoff.duration()
+            if max_delay is not None:
+                delay = min(delay, max_delay)
+        deadline = time.time() + delay
+        time.sleep(delay)
+        if request:
+            self.acquire(deadline)
+
+    def forget(self, key):
+        with self._cond:
+            self._backoffs.pop(key, None)
+
+    def acquire(self, deadline=None):
+        # Take one request from the global budget, earliest deadline first
+        entry = (deadline if deadline is not None else time.time(), next(self._seq))
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+            while True:
+                self._refill()
+                if self._queue[0] == entry and self._tokens >= 1:
+                    heapq.heappop(self._queue)
+                    self._tokens -= 1
+                    self._cond.notify_all()
+                    return
+                self._cond.wait(max(0.01, (1 - self._tokens) / self.rate))
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(float(self.rate), self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+
+scheduler = PollScheduler()
+
+
+class JobStateCache(object):
+    """Job states shared by every watcher in the process.
+
+    Terminal states are remembered for good and other states for one tick,
+    and concurrent lookups of the same job share a single request.
+    """
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # job_id -> (fetched_at, state)
+        self._states = {}
+        # job_id -> Event set once the request in flight for it returns
+        self._inflight = {}
+
+    def terminal_state(self, job_id):
+        state = self._states.get(job_id, (None, None))[1]
+        if state in TERMINAL_JOB_STATES:
+            return state
+
+    def update(self, job_id, state):
+        with self._lock:
+            self._states[job_id] = (time.time(), state)
+
+    def get_state(self, gi, job_id):
+        while True:
+            with self._lock:
+                fetched_at, state = self._states.get(job_id, (None, None))
+                if state in TERMINAL_JOB_STATES or \
+                        (fetched_at is not None and time.time() - fetched_at < self.interval):
+                    return state
+                event = self._inflight.get(job_id)
+                leader = event is None
+                if leader:
+                    event = self._inflight[job_id] = threading.Event()
+            if not leader:
+                # Someone else is already asking, use their answer
+                event.wait()
+                continue
+            try:
+                scheduler.acquire()
+                state = gi.jobs.get_state(job_id)
+                self.update(job_id, state)
+                return state
+            finally:
+                with self._lock:
+                    del self._inflight[job_id]
+                event.set()
+
+
+job_states = JobStateCache()
+
+
+class StatePoller(object):
+    """Fetch the state of every outstanding invocation and job with one round
+    of listing calls per tick, and fan the results out to the watchers.
+
+    Watchers call ``show_invocation``/``get_state`` in place of the bioblend
+    methods of the same name; each call blocks until the next tick has
+    fetched that object. Watchers still pace themselves with the
+    :class:`PollScheduler`, so only those that are due join a tick.
+
+    After ``max_failures`` ticks in a row fail, the last error is raised to
+    the waiting watchers instead of being retried again.
+    """
+
+    def __init__(self, gi, interval=2, max_failures=5):
+        self.gi = gi
+        self.interval = interval
+        self.max_failures = max_failures
+        self._failures = 0
+        # Our jobs can't predate the poller, so that bounds the job listing
+        self.since = datetime.datetime.utcnow().date()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._tick = 0
+        # Objects with a watcher waiting on them, and the latest (tick, value)
+        self._pending = set()
+        self._results = {}
+        # Full step documents per invocation, fetched until it is scheduled
+        # and every tool step has its job
+        self._steps = {}
+        # wf_id -> order indexes of its tool steps
+        self._tool_steps = {}
+
+    def show_invocation(self, wf_id, invoke_id):
+        return self._wait(('invocation', wf_id, invoke_id))
+
+    def get_state(self, job_id):
+        # Finished jobs never change, so don't wait a tick for them
+        state = job_states.terminal_state(job_id)
+        if state is not None:
+            return state
+        return self._wait(('job', job_id))
+
+    def _wait(self, key):
+        with self._cond:
+            start_tick = self._tick
+            self._pending.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            while self._results.get(key, (start_tick, None))[0] <= start_tick:
+                self._cond.wait()
+            value = self._results[key][1]
+            if isinstance(value, Exception):
+                raise value
+            return value
+
+    def _run(self):
+        while True:
+            with self._cond:
+                requested = self._pending
+                self._pending = set()
+                if not requested:
+                    self._thread = None
+                    return
+            try:
+                with tracer.span('poll', requested=len(requested)):
+                    results = self._poll(requested)
+            except Exception as e:
+                self._failures += 1
+                with self._cond:
+                    if self._failures < self.max_failures:
+                        logging.warning("Polling failed, will retry: %s", e)
+                        self._pending |= requested
+                    else:
+                        # Give up on this round; watchers still waiting ask again
+                        logging.error("Polling failed %s times in a row: %s", self._failures, e)
+                        self._failures = 0
+                        self._tick += 1
+                        for key in requested:
+                            self._results[key] = (self._tick, e)
+                        self._cond.notify_all()
+            else:
+                self._failures = 0
+                with self._cond:
+                    self._tick += 1
+                    for key, value in results.items():
+                        self._results[key] = (self._tick, value)
+                    self._cond.notify_all()
+            time.sleep(self.interval)
+
+    def _poll(self, requested):
+        invocations = [key[1:] for key in requested if key[0] == 'invocation']
+        job_ids = set(key[1] for key in requested if key[0] == 'job')
+
+        # Invocations are fetched one by one, and only until their steps all
+        # have jobs; after that, their jobs' states are all that changes
+        fresh = {}
+        for key in invocations:
+            if key in self._steps:
+                job_ids.update(step['job_id'] for step in self._steps[key] if step.get('job_id'))
+                continue
+            scheduler.acquire()
+            doc = fresh[key] = self.gi.workflows.show_invocation(*key)
+            if doc['state'] == 'scheduled' and self._has_jobs(key[0], doc['steps']):
+                self._steps[key] = doc['steps']
+
+        polled_states = self._job_states(job_ids)
+
+        results = {}
+        for key in invocations:
+            if key in fresh:
+                doc = fresh[key]
+            else:
+                steps = [dict(step, state=polled_states.get(step.get('job_id'), step['state']))
+                         for step in self._steps[key]]
+                doc = {'id': key[1], 'workflow_id': key[0], 'state': 'scheduled', 'steps': steps}
+            results[('invocation',) + key] = doc
+        for key in requested:
+            if key[0] == 'job':
+                results[key] = polled_states[key[1]]
+        logging.debug("Polled %s invocations and %s jobs", len(invocations), len(job_ids))
+        return results
+
+    def _has_jobs(self, wf_id, steps):
+        # Whether every tool step of the workflow has been given a job yet
+        if wf_id not in self._tool_steps:
+            scheduler.acquire()
+            workflow = self.gi.workflows.show_workflow(wf_id)
+            self._tool_steps[wf_id] = set(int(step['id']) for step in workflow['steps'].values()
+                                          if step.get('type') == 'tool')
+        with_jobs = set(step.get('order_index') for step in steps if step.get('job_id'))
+        return self._tool_steps[wf_id] <= with_jobs
+
+    def _job_states(self, job_ids):
+        states = {}
+        for job_id in job_ids:
+            state = job_states.terminal_state(job_id)
+            if state is not None:
+                states[job_id] = state
+        job_ids = job_ids - set(states)
+        states.update(self._fetch_job_states(job_ids))
+        return states
+
+    def _fetch_job_states(self, job_ids):
+        if len(job_ids) <= 1:
+            states = {}
+            for job_id in job_ids:
+                scheduler.acquire()
+                states[job_id] = self.gi.jobs.get_state(job_id)
+            for job_id, state in states.items():
+                job_states.update(job_id, state)
+            return states
+
+        # One listing of our jobs since the day the poller started covers
+        # every job we watch. Galaxy lists the most recently updated first,
+        # so the limit only leaves out jobs that haven't changed in a while.
+        scheduler.acquire()
+        user_id = self.gi.current_user_id()
+        scheduler.acquire()
+        listed = self.gi.jobs._get(params={
+            'user_id': user_id,
+            'date_range_min': self.since.isoformat(),
+            'limit': max(100, 2 * len(job_ids)),
+        })
+        states = {job['id']: job['state'] for job in listed if job['id'] in job_ids}
+        for job_id, state in states.items():
+            job_states.update(job_id, state)
+        # Anything the listing missed (beyond the limit, filters unsupported
+        # by older Galaxy) falls back to an individual lookup
+        for job_id in job_ids - set(states):
+            states[job_id] = job_states.get_state(self.gi, job_id)
+        return states
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+import os
+import time
+import shutil
+import threading
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import quoteattr
+from junit_xml import TestSuite
+
+
+class ReportFile(object):
+    """A report at ``path`` that grows as fragments are appended to it, yet is
+    always a complete document.
+
+    Fragments go straight to an append-only journal next to the report
+    (``path + '.journal'``), so the report is never held in memory. The
+    report is rebuilt from the journal, as ``head + fragments + tail``, into
+    a temporary file and moved over ``path`` with os.replace: readers (and
+    whatever a killed run leaves behind) only ever see a whole document. It
+    is republished at most every ``interval`` seconds, and on close.
+    """
+
+    def __init__(self, path, head, tail, interval=1):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.head = head
+        self.tail = tail
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._journal = open(self.journal_path, 'w')
+        self._published = 0
+        self.publish()
+
+    def append(self, fragment, head=None):
+        # ``head`` replaces the document's head, e.g. with updated totals
+        with self._lock:
+            self._journal.write(fragment + '\n')
+            self._journal.flush()
+            if head is not None:
+                self.head = head
+            if time.time() - self._published >= self.interval:
+                self._publish()
+
+    def publish(self):
+        with self._lock:
+            self._publish()
+
+    def close(self):
+        with self._lock:
+            self._publish()
+            self._journal.close()
+            os.remove(self.journal_path)
+
+    def _publish(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as handle, open(self.journal_path, 'r') as journal:
+            handle.write(self.head)
+            shutil.copyfileobj(journal, handle)
+            handle.write(self.tail)
+        os.replace(tmp_path, self.path)
+        self._published = time.time()
+
+
+class XunitReport(object):
+    """Test suites (see xunit_wrapper.xunit_suite) written to ``path`` as they
+    are made, in the layout of xunit_dump(), through a :class:`ReportFile`."""
+
+    def __init__(self, path, interval=1):
+        self._lock = threading.Lock()
+        self.totals = {'tests': 0, 'failures': 0, 'errors': 0, 'time': 0.0}
+        self.file = ReportFile(path, self._head(), '</testsuites>\n', interval)
+
+    def add(self, suite):
+        element = suite.build_xml_doc()
+        fragment = TestSuite._clean_illegal_xml_chars(ET.tostring(element, encoding='unicode'))
+        with self._lock:
+            for key in ('tests', 'failures', 'errors'):
+                self.totals[key] += int(element.get(key, 0))
+            self.totals['time'] += float(element.get('time', 0))
+            self.file.append(fragment, self._head())
+
+    def extend(self, suites):
+        for suite in suites:
+            self.add(suite)
+
+    def close(self):
+        self.file.close()
+
+    def _head(self):
+        attributes = ' '.join('%s=%s' % (key, quoteattr(str(value))) for key, value in sorted(self.totals.items()))
+        return '<?xml version="1.0" ?>\n<testsuites %s>\n' % attributes
@@ -4,8 +4,13 @@ import os
 import time
 import logging
 import datetime
-from bioblend import galaxy
-from xunit_wrapper import xunit, xunit_suite, xunit_dump
+from concurrent.futures import ThreadPoolExecutor
+from client import galaxy_instance
+from cache import CACHE_DB, ExportCache
+from poller import StatePoller, job_states, scheduler
+from report import XunitReport
+from tracing import tracer
+from xunit_wrapper import xunit, xunit_suite
 
 logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.DEBUG)
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -24,11 +29,21 @@ def __main__():
     parser.add_argument('-u', '--url', dest='url', metavar="http://galaxy_url:port",
                         help="Be sure to specify the port on which galaxy is running",
                         default="http://usegalaxy.org")
-    parser.add_argument('-x', '--xunit-output', dest="xunit_output", type=argparse.FileType('w'), default='report.xml',
-                        help="""Location to store xunit report in""")
+    parser.add_argument('-x', '--xunit-output', dest="xunit_output", default='report.xml',
+                        help="""Location to store xunit report in, updated as each test finishes""")
+    parser.add_argument('-j', '--concurrency', dest="concurrency", type=int, default=1,
+                        help="""Number of organisms to export at once""")
+    parser.add_argument('--cache-db', dest="cache_db", default=CACHE_DB,
+                        help="""Local cache of previous Webapollo exports""")
+    parser.add_argument('--no-export-cache', dest="export_cache", action="store_false", default=True,
+                        help="""Always run a fresh Webapollo export""")
+    parser.add_argument('--trace', dest="trace", default=None,
+                        help="""Write a Chrome trace (chrome://tracing, Perfetto) of every galaxy API call to this file""")
     args = parser.parse_args()
+    if args.trace:
+        tracer.start()
 
-    gi = galaxy.GalaxyInstance(args.url, args.key)
+    gi = galaxy_instance(args.url, args.key)
     hist = gi.histories.create_history('Load All Student Genomes')
 
 
@@ -37,17 +52,35 @@ def __main__():
                  'SCS', 'SL-Ken', 'ScaAbd', 'ScaApp', 'Sw1_3003', 'Sw2-Ken',
                  'UDP')
 
-    test_suites = []
-    for name in org_names:
-        ts = retrieve_and_rename(gi, hist, name)
-        test_suites.append(ts)
-    args.xunit_output.write(xunit_dump(test_suites))
-
-
-def retrieve_and_rename(gi, hist, ORG_NAME):
+    # Exports are independent, so run several at once and watch their jobs
+    # through one shared poller. Suites stay in organism order.
+    poller = StatePoller(gi)
+    export_cache = ExportCache(args.cache_db) if args.export_cache else None
+    report = XunitReport(args.xunit_output)
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for ts in pool.map(lambda name: retrieve_and_rename(gi, hist, name, poller=poller,
+                                                                export_cache=export_cache), org_names):
+                report.add(ts)
+    finally:
+        report.close()
+        if args.trace:
+            tracer.dump(args.trace)
+
+
+def retrieve_and_rename(gi, hist, ORG_NAME, poller=None, export_cache=None):
     logging.info("Retrieving and Renaming %s", ORG_NAME)
+    signal = None
+    if export_cache is not None:
+        # Reuse the last export if the annotations haven't changed since
+        signal, cached = export_cache.lookup(gi, ORG_NAME)
+        if cached is not None:
+            with xunit('galaxy', 'copy_cached_export') as tc_cached, tracer.span('copy_cached_export'):
+                logging.info("Copying cached export of %s", ORG_NAME)
+                export_cache.copy_into(gi, hist, ORG_NAME, cached)
+            return xunit_suite('Fetching ' + ORG_NAME, [tc_cached])
     # Now we'll run this tool
-    with xunit('galaxy', 'launch_tool') as tc3:
+    with xunit('galaxy', 'launch_tool') as tc3, tracer.span('launch_tool', organism=ORG_NAME):
         logging.info("Running tool")
         inputs = {
             'org_source|source_select': 'direct',
@@ -56,8 +89,10 @@ def retrieve_and_rename(gi, hist, ORG_NAME):
         tool_run = gi.tools.run_tool(hist['id'], 'edu.tamu.cpt2.webapollo.export', inputs)
     # Now to correct the names
 
-    with xunit('galaxy', 'watch_run') as tc4:
-        (successful, msg) = watch_job_invocation(gi, tool_run['jobs'][0]['id'])
+    # Stays False if the watch raises, which xunit records and swallows
+    successful = False
+    with xunit('galaxy', 'watch_run') as tc4, tracer.span('watch_run', organism=ORG_NAME):
+        (successful, msg) = watch_job_invocation(gi, tool_run['jobs'][0]['id'], poller=poller)
 
     rename_tcs = []
     logging.info("Run complete, renaming outputs")
@@ -73,28 +108,38 @@ def retrieve_and_rename(gi, hist, ORG_NAME):
         logging.debug("Renaming %s (%s, %s) to %s", dataset['id'], dataset['data_type'], dataset['file_ext'], name)
 
         with xunit('galaxy', 'rename.%s' % dataset['file_ext']) as tmp_tc:
-            (successful, msg) = watch_job_invocation(gi, tool_run['jobs'][0]['id'])
+            (successful, msg) = watch_job_invocation(gi, tool_run['jobs'][0]['id'], poller=poller)
             gi.histories.update_dataset(hist['id'], dataset['id'], name=name)
 
         rename_tcs.append(tmp_tc)
 
+    if export_cache is not None and successful and not any(tc._tc.is_failure() for tc in [tc4] + rename_tcs):
+        export_cache.record(ORG_NAME, signal, {dataset['file_ext']: dataset['id'] for dataset in tool_run['outputs']})
     ts = xunit_suite('Fetching ' + ORG_NAME, [tc3, tc4] + rename_tcs)
     return ts
 
-def watch_job_invocation(gi, job_id):
+def watch_job_invocation(gi, job_id, poller=None):
     latest_state = None
-    while True:
-        # Fetch the current state
-        latest_state = gi.jobs.get_state(job_id)
-        # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
-        logging.debug("Checking job %s state: %s", job_id, latest_state)
-        if latest_state == 'error':
-            return False, latest_state
-        elif latest_state == 'ok':
-            return True, None
-        else:
-            time.sleep(5)
-    return False, latest_state
+    prev_state = None
+    key = ('job', job_id)
+    try:
+        while True:
+            # Fetch the current state
+            if poller is not None:
+                latest_state = poller.get_state(job_id)
+            else:
+                latest_state = job_states.get_state(gi, job_id)
+            # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
+            logging.debug("Checking job %s state: %s", job_id, latest_state)
+            if latest_state == 'error':
+                return False, latest_state
+            elif latest_state == 'ok':
+                return True, None
+            # Poll again sooner if the state just changed
+            scheduler.wait(key, changed=latest_state != prev_state, request=False)
+            prev_state = latest_state
+    finally:
+        scheduler.forget(key)
 
 
 def watch_workflow_invocation(gi, wf_id, invoke_id):
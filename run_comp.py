@@ -2,12 +2,19 @@
 import argparse
 import os
 import glob
-import time
 import logging
 import datetime
-from justbackoff import Backoff
-from bioblend import galaxy
-from xunit_wrapper import xunit, xunit_suite, xunit_dump
+from concurrent.futures import ThreadPoolExecutor
+from client import galaxy_instance
+from run_wf import add_common_args, watch_workflow_invocations
+from cache import RunHistory, StepTimings, UploadIndex
+from checkpoint import Checkpoint, case_result, resumed_case
+from poller import scheduler
+from uploads import ChunkedUploader
+from metrics import StepMetrics, completion_cases, sidecar_path
+from tracing import tracer
+from report import XunitReport
+from xunit_wrapper import xunit, xunit_suite
 
 
 logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.DEBUG)
@@ -15,59 +22,95 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("bioblend").setLevel(logging.WARNING)
 NOW = datetime.datetime.now()
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-backoff = Backoff(min_ms=100, max_ms=1000 * 60 * 5, factor=2, jitter=False)
 BUILD_ID = os.environ.get('BUILD_NUMBER', 'Manual-%s' % NOW.strftime('%Y.%m.%dT%H:%M'))
+WORKFLOW_ID = '95c345e5129ac7f2'
+ORG_NAMES = ('Soft', '2ww-3119', 'ISA', 'Inf_Still_Creek', 'J76', 'K6',
+             'K7', 'K8', 'MIS1-LT2', 'MIS3-3117', 'MP16', 'Pin', 'SCI',
+             'SCS', 'SL-Ken', 'ScaAbd', 'ScaApp', 'Sw1_3003', 'Sw2-Ken',
+             'UDP', '5ww_LT2', 'Sw2-Np2', 'CCS')
 
 def __main__():
     parser = argparse.ArgumentParser(description="""Script to run all workflows mentioned in workflows_to_test.
     It will import the shared workflows are create histories for each workflow run, prefixed with ``TEST_RUN_<date>:``
     Make sure the yaml has file names identical to those in the data library.""")
 
-    parser.add_argument('-k', '--api-key', '--key', dest='key', metavar='your_api_key',
-                        help='The account linked to this key needs to have admin right to upload by server path',
-                        required=True)
-    parser.add_argument('-u', '--url', dest='url', metavar="http://galaxy_url:port",
-                        help="Be sure to specify the port on which galaxy is running",
-                        default="http://usegalaxy.org")
-    parser.add_argument('-x', '--xunit-output', dest="xunit_output", type=argparse.FileType('w'), default='report.xml',
-                        help="""Location to store xunit report in""")
+    add_common_args(parser, __file__, pipeline=False)
+    parser.add_argument('--upload-workers', dest="upload_workers", type=int, default=4,
+                        help="""Number of files to upload at once""")
+    parser.add_argument('--no-dedup', dest="dedup", action="store_false", default=True,
+                        help="""Always upload, even if the server already has an identical file""")
     args = parser.parse_args()
+    if args.trace:
+        tracer.start()
+    scheduler.rate = args.max_rps
 
-    gi = galaxy.GalaxyInstance(args.url, args.key)
-    wf = gi.workflows.get_workflows(workflow_id='95c345e5129ac7f2')[0]
-
-    org_names = ('Soft', '2ww-3119', 'ISA', 'Inf_Still_Creek', 'J76', 'K6',
-                 'K7', 'K8', 'MIS1-LT2', 'MIS3-3117', 'MP16', 'Pin', 'SCI',
-                 'SCS', 'SL-Ken', 'ScaAbd', 'ScaApp', 'Sw1_3003', 'Sw2-Ken',
-                 'UDP', '5ww_LT2', 'Sw2-Np2', 'CCS')
+    gi = galaxy_instance(args.url, args.key)
+    index = UploadIndex(args.cache_db) if args.dedup else None
+    uploader = ChunkedUploader(gi, max_workers=args.upload_workers, index=index)
+    wf = gi.workflows.get_workflows(workflow_id=WORKFLOW_ID)[0]
 
     wf_data = gi.workflows.show_workflow(wf['id'])
     wf_inputs = wf_data['inputs']
-    test_suites = []
+    checkpoint = Checkpoint(args.checkpoint, resume=args.resume)
+    report = XunitReport(args.xunit_output)
+    step_metrics = StepMetrics(sidecar_path(args.xunit_output)) if args.step_metrics else None
+    history = RunHistory(args.cache_db, BUILD_ID) if args.history else None
     wf_invocations = []
-    for name in org_names:
-        try:
-            hist = gi.histories.create_history(name='BuildID=%s WF=%s Org=%s Source=Jenkins' % (BUILD_ID, wf_data['name'].replace(' ', '_'), name))
-            gi.histories.create_history_tag(hist['id'], 'Automated')
-            gi.histories.create_history_tag(hist['id'], 'Annotation')
-            gi.histories.create_history_tag(hist['id'], 'BICH464')
+    # invoke_id -> organism, to checkpoint and report each result
+    invoked_orgs = {}
+    for name in ORG_NAMES:
+        key = '%s:%s' % (wf['id'], name)
+        done = checkpoint.get(key)
+        if 'result' in done:
+            tc_watch = resumed_case('workflow_watch.%s.%s' % tuple(done['invocation']), done['result'])
+            report.add(xunit_suite('[%s] Workflow Completion' % name, [tc_watch]))
+            continue
+        if 'invocation' in done:
+            logging.info("Reattaching to wf %s invocation %s", *done['invocation'])
+            report.add(xunit_suite('[%s] Invoking workflow' % name, [resumed_case('resumed.invoke')]))
+            wf_invocations.append(tuple(done['invocation']))
+            invoked_orgs[done['invocation'][1]] = name
+            continue
+        hist = done.get('history')
+        if hist is None:
+            with xunit('galaxy', 'pipeline.create_history') as tc_stage, tracer.span('create_history', organism=name):
+                hist = gi.histories.create_history(name='BuildID=%s WF=%s Org=%s Source=Jenkins' % (BUILD_ID, wf_data['name'].replace(' ', '_'), name))
+                gi.histories.create_history_tag(hist['id'], 'Automated')
+                gi.histories.create_history_tag(hist['id'], 'Annotation')
+                gi.histories.create_history_tag(hist['id'], 'BICH464')
+            if tc_stage._tc.is_failure():
+                report.add(xunit_suite('[%s] Pipeline' % name, [tc_stage]))
+                continue
+            checkpoint.record(key, 'history', {'id': hist['id'], 'name': hist['name']})
+
+        datasetMap = done.get('datasets')
+        if datasetMap is None:
             # Load the datasets into history
             files = glob.glob('tmp/%s*' % name)
-            for f in sorted(files):
-                # Skip blastxml
-                if '.NR.blastxml' in f: continue
-                gi.tools.upload_file(f, hist['id'])
-
-            datasets = gi.histories.show_history(hist['id'], contents=True)
-            datasetMap = {
-                dataset['name'].replace(name + '.', ''): dataset['id']
-                for dataset in datasets
-            }
-
-            import pprint; pprint.pprint(datasetMap)
-
-            # TODO: fix mapping to always work.
-            # Map our inputs for invocation
+            # Skip blastxml
+            files = [f for f in sorted(files) if '.NR.blastxml' not in f]
+            with tracer.span('upload', organism=name):
+                upload_test_cases = upload_data(uploader, files, hist)
+            report.add(xunit_suite('[%s] Uploading data' % name, upload_test_cases))
+            if any(tc._tc.is_failure() for tc in upload_test_cases):
+                continue
+
+            with xunit('galaxy', 'pipeline.datasets') as tc_stage:
+                datasets = gi.histories.show_history(hist['id'], contents=True)
+                datasetMap = {
+                    dataset['name'].replace(name + '.', ''): dataset['id']
+                    for dataset in datasets
+                }
+            if tc_stage._tc.is_failure():
+                report.add(xunit_suite('[%s] Pipeline' % name, [tc_stage]))
+                continue
+            checkpoint.record(key, 'datasets', datasetMap)
+
+        import pprint; pprint.pprint(datasetMap)
+
+        # TODO: fix mapping to always work.
+        # Map our inputs for invocation
+        with xunit('galaxy', 'pipeline.inputs') as tc_stage:
             inputs = {
                 '0': {
                     'id': datasetMap['fa'],
@@ -90,32 +133,41 @@ def __main__():
                     'src': 'hda',
                 },
             }
-
-            # Invoke Workflow
-            wf_test_cases, watchable_invocation = run_workflow(gi, wf, inputs, hist)
-            # Invoke Workflow test cases
-            ts = xunit_suite('[%s] Invoking workflow' % name, wf_test_cases)
-            test_suites.append(ts)
-
-            # Store the invocation info for watching later.
-            wf_invocations.append(watchable_invocation)
-        except:
-            pass
-
-    invoke_test_cases = []
-    for (wf_id, invoke_id) in wf_invocations:
-        with xunit('galaxy', 'workflow_watch.%s.%s' % (wf_id, invoke_id)) as tc_watch:
-            logging.info("Waiting on wf %s invocation %s", wf_id, invoke_id)
-            watch_workflow_invocation(gi, wf_id, invoke_id)
-        invoke_test_cases.append(tc_watch)
-    ts = xunit_suite('[%s] Workflow Completion' % name, invoke_test_cases)
-    args.xunit_output.write(xunit_dump(test_suites))
+        if tc_stage._tc.is_failure():
+            report.add(xunit_suite('[%s] Pipeline' % name, [tc_stage]))
+            continue
+
+        # Invoke Workflow
+        wf_test_cases, watchable_invocation = run_workflow(gi, wf, inputs, hist)
+        # Invoke Workflow test cases
+        ts = xunit_suite('[%s] Invoking workflow' % name, wf_test_cases)
+        report.add(ts)
+        if watchable_invocation is None:
+            continue
+
+        # Store the invocation info for watching later.
+        wf_invocations.append(watchable_invocation)
+        invoked_orgs[watchable_invocation[1]] = name
+        checkpoint.record(key, 'invocation', list(watchable_invocation))
+
+    timings = StepTimings(args.cache_db) if args.predict else None
+    for tc_watch in watch_workflow_invocations(gi, wf_invocations, timings=timings):
+        invoke_id = tc_watch._classname.rsplit('.', 1)[1]
+        name = invoked_orgs[invoke_id]
+        checkpoint.record('%s:%s' % (wf['id'], name), 'result', case_result(tc_watch))
+        watch_test_cases = completion_cases(gi, wf['id'], invoke_id, tc_watch, name, step_metrics, history)
+        report.add(xunit_suite('[%s] Workflow Completion' % name, watch_test_cases))
+    report.close()
+    if step_metrics is not None:
+        step_metrics.close()
+    if args.trace:
+        tracer.dump(args.trace)
 
 
 def run_workflow(gi, wf, inputs, hist):
     test_cases = []
 
-    with xunit('galaxy', 'workflow_launch') as tc_invoke:
+    with xunit('galaxy', 'workflow_launch') as tc_invoke, tracer.span('workflow_launch', workflow=wf['id']):
         logging.info("Running wf %s in %s", wf['id'], hist['id'])
         invocation = gi.workflows.invoke_workflow(
             wf['id'],
@@ -123,64 +175,23 @@ def run_workflow(gi, wf, inputs, hist):
             history_id=hist['id'],
         )
     test_cases.append(tc_invoke)
+    if tc_invoke._tc.is_failure():
+        return test_cases, None
     watchable_invocation = (wf['id'], invocation['id'])
 
     return test_cases, watchable_invocation
 
 
-def watch_job_invocation(gi, job_id):
-    latest_state = None
-    prev_state = None
-
-    while True:
-        # Fetch the current state
-        latest_state = gi.jobs.get_state(job_id)
-        # If the state changes
-        if latest_state != prev_state:
-            # Reset the backoff
-            backoff.reset()
-        prev_state = latest_state
-
-        # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
-        logging.debug("Checking job %s state: %s", job_id, latest_state)
-        if latest_state == 'error':
-            raise Exception(latest_state)
-        elif latest_state == 'ok':
-            return
-        else:
-            time.sleep(backoff.duration())
-    raise Exception(latest_state)
-
-
-def watch_workflow_invocation(gi, wf_id, invoke_id):
-    latest_state = None
-    prev_state = None
-    while True:
-        # Fetch the current state
-        latest_state = gi.workflows.show_invocation(wf_id, invoke_id)
-        # Get step states
-        states = [step['state'] for step in latest_state['steps']]
-        # Get a str based state representation
-        state_rep = '|'.join(map(str, states))
-        if state_rep != prev_state:
-            backoff.reset()
-        prev_state = state_rep
-
-        # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
-        if latest_state['state'] == 'scheduled':
-            # If any state is in error,
-            logging.info("Checking workflow %s states: %s", wf_id, state_rep)
-            if any([state == 'error' for state in states]):
-                # We bail
-                raise Exception(latest_state)
-
-            # If all OK
-            if all([state is None or state == 'ok'
-                    for state in states]):
-                return
-                # We can finish
-        time.sleep(backoff.duration())
-    raise Exception(latest_state)
+def upload_data(uploader, files, hist):
+    # A test case per file, so a failed upload shows in the report
+    def upload(path):
+        with xunit('galaxy', 'upload.%s' % os.path.basename(path)) as tc_upload:
+            uploader.upload_file(path, hist['id'])
+        return tc_upload
+
+    with ThreadPoolExecutor(max_workers=uploader.max_workers) as pool:
+        return list(pool.map(upload, files))
+
 
 
 if __name__ == "__main__":
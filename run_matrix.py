@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+import argparse
+import os
+import yaml
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from client import galaxy_instance
+from cache import ExportCache, RunHistory, RunTimings, StepTimings
+from checkpoint import Checkpoint
+from planning import AdmissionController, Plan, PrioritySlots
+from poller import StatePoller, scheduler
+from run_wf import add_common_args, run_pipeline, retrieve_and_rename, wait_for_invocation_ready, watch_one
+from metrics import StepMetrics, completion_cases, sidecar_path
+from tracing import tracer
+from report import XunitReport
+from xunit_wrapper import xunit, xunit_suite
+
+
+logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.DEBUG)
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("bioblend").setLevel(logging.WARNING)
+NOW = datetime.datetime.now()
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BUILD_ID = os.environ.get('BUILD_NUMBER', 'Manual-%s' % NOW.strftime('%Y.%m.%dT%H:%M'))
+HISTORY_NAME = 'BuildID=%(build)s WF=%(workflow)s Org=%(organism)s Source=Jenkins'
+# Output datasets in these states fail their organism; in these others
+# they are still to finish
+FAILED_DATASET_STATES = ('error', 'failed_metadata', 'discarded', 'paused')
+PENDING_DATASET_STATES = ('new', 'upload', 'queued', 'running', 'setting_metadata')
+
+
+def __main__(script=__file__, workflow=None):
+    # With ``workflow`` (an id or name), only that manifest entry runs; the
+    # run_wf*.py scripts are this, for their workflow
+    if workflow is None:
+        description = """Run every workflow x organism pair listed in a manifest (see testdata/pipelines.yaml)
+        in one process, sharing one galaxy session, poller and export cache."""
+    else:
+        description = """Run one workflow (%s) of a manifest (see testdata/pipelines.yaml) on each of its
+        organisms.""" % workflow
+    parser = argparse.ArgumentParser(description=description)
+
+    add_common_args(parser, script)
+    parser.add_argument('-w', "--yaml", "--manifest", dest="yaml", type=argparse.FileType('r'), metavar="Manifest yaml file",
+                        help="Specify a yaml file listing the workflows, organisms and input mappings to run",
+                        default=os.path.join(SCRIPT_DIR, 'testdata', 'pipelines.yaml'))
+    if workflow is None:
+        parser.add_argument('--workflow', dest="workflows", action='append', default=[],
+                            help="""Id or name of a manifest workflow to run; may be repeated (default: all)""")
+    parser.add_argument('--batch', dest="batch", action="store_true", default=False,
+                        help="""Run each workflow as one batched invocation over all its organisms""")
+    parser.add_argument('--max-active', dest="max_active", type=int, default=None,
+                        help="""Most invocations to have running at once, across all workflows""")
+    args = parser.parse_args()
+    if args.trace:
+        tracer.start()
+    scheduler.rate = args.max_rps
+
+    manifest = yaml.safe_load(args.yaml)
+    selected = [workflow] if workflow is not None else args.workflows
+    if selected:
+        manifest = [entry for entry in manifest if entry['id'] in selected or entry.get('name') in selected]
+        if not manifest:
+            parser.error("%s not in the manifest" % ', '.join(selected))
+    gi = galaxy_instance(args.url, args.key)
+    if args.batch:
+        for entry in manifest:
+            entry['batch'] = True
+    admission = None
+    if args.max_queued or args.max_inflight:
+        admission = AdmissionController(gi, max_jobs=args.max_queued, max_inflight=args.max_inflight)
+    plan = Plan(RunTimings(args.cache_db), workers=args.max_active) if args.predict else None
+    report = XunitReport(args.xunit_output)
+    step_metrics = StepMetrics(sidecar_path(args.xunit_output)) if args.step_metrics else None
+    try:
+        run_matrix(gi, manifest, max_active=args.max_active, ready_timeout=args.ready_timeout,
+                   export_cache=ExportCache(args.cache_db) if args.export_cache else None,
+                   timings=StepTimings(args.cache_db) if args.predict else None,
+                   plan=plan, admission=admission,
+                   checkpoint=Checkpoint(args.checkpoint, resume=args.resume),
+                   report=report, step_metrics=step_metrics,
+                   history=RunHistory(args.cache_db, BUILD_ID) if args.history else None)
+        if plan is not None:
+            report.add(plan.report('Matrix' if workflow is None else manifest[0].get('name', workflow)))
+    finally:
+        report.close()
+        if step_metrics is not None:
+            step_metrics.close()
+        if args.trace:
+            tracer.dump(args.trace)
+
+
+def input_mapper(inputs):
+    # Turn the manifest's step -> file extension mapping into map_inputs()
+    def map_inputs(datasets):
+        mapped = {}
+        for step, source in inputs.items():
+            if isinstance(source, dict):
+                mapped[str(step)] = source
+            else:
+                mapped[str(step)] = {'id': datasets[source]['id'], 'src': 'hda'}
+        return mapped
+    return map_inputs
+
+
+def run_matrix(gi, manifest, max_active=None, **kwargs):
+    # Every workflow runs its own pipeline, all at once, behind one poller and
+    # (optionally) one cap on running invocations.
+    entries = [entry for entry in manifest if entry.get('organisms')]
+    if not entries:
+        return []
+    kwargs.setdefault('poller', StatePoller(gi))
+    if max_active:
+        kwargs['slots'] = PrioritySlots(max_active)
+    plan = kwargs.get('plan')
+    if plan is not None:
+        # Start the workflows with the most expected work first; the slots
+        # then go to the longest runs across all of them
+        submit_order = sorted(entries, key=lambda entry: plan.total(entry['id'], entry['organisms']))
+    else:
+        submit_order = entries
+
+    with ThreadPoolExecutor(max_workers=len(entries)) as pool:
+        futures = dict((id(entry), pool.submit(run_entry, gi, entry, **kwargs)) for entry in submit_order)
+        # Suites stay in manifest order
+        test_suites = []
+        for entry in entries:
+            test_suites.extend(futures[id(entry)].result())
+    return test_suites
+
+
+def run_entry(gi, entry, **kwargs):
+    wf = gi.workflows.get_workflows(workflow_id=entry['id'])[0]
+    label = entry.get('name', wf['name'])
+    history_name = entry.get('history_name', HISTORY_NAME) % {
+        'build': BUILD_ID,
+        'workflow': wf['name'].replace(' ', '_'),
+        'organism': '%s',
+    }
+    logging.info("Running %s on %s organisms", label, len(entry['organisms']))
+    if entry.get('batch', False):
+        if kwargs.pop('checkpoint', None) is not None:
+            # One invocation for many organisms doesn't fit the per-organism journal
+            logging.warning("Batched runs of %s are not checkpointed", label)
+        return run_batch(gi, wf, entry['organisms'], history_name, entry['inputs'], label=label, **kwargs)
+    return run_pipeline(gi, wf, entry['organisms'], history_name, input_mapper(entry['inputs']),
+                        label=label, **kwargs)
+
+
+def run_batch(gi, wf, org_names, history_name, inputs, poller=None, ready_timeout=60, export_cache=None,
+              slots=None, label=None, timings=None, plan=None, admission=None, max_fetch=4, report=None,
+              step_metrics=None, history=None):
+    # One history and one invocation request for every organism: the exports
+    # all land in one history, are packed into a list collection per input,
+    # and the workflow is run in batch over those collections. Results are
+    # split back out into per-organism suites.
+    test_suites = []
+
+    def emit(suite):
+        if label is not None:
+            suite.properties = {'workflow': label}
+        test_suites.append(suite)
+        if report is not None:
+            report.add(suite)
+
+    def completion(name, invoke_id, tc_watch):
+        watch_test_cases = completion_cases(gi, wf['id'], invoke_id, tc_watch, name, step_metrics, history)
+        return xunit_suite('[%s] Workflow Completion' % name, watch_test_cases)
+
+    def stage(name, stage_name, func, *args):
+        # As run_pipeline's stages: a failure is reported, and None returned
+        with xunit('galaxy', 'pipeline.%s' % stage_name) as tc_stage, tracer.span(stage_name, organism=name):
+            result = func(*args)
+        if tc_stage._tc.is_failure():
+            emit(xunit_suite('[%s] Pipeline' % name, [tc_stage]))
+            return None
+        return result
+
+    def create_history():
+        hist = gi.histories.create_history(name=history_name % 'Batch')
+        gi.histories.create_history_tag(hist['id'], 'Automated')
+        gi.histories.create_history_tag(hist['id'], 'Annotation')
+        gi.histories.create_history_tag(hist['id'], 'BICH464')
+        return hist
+
+    hist = stage('Batch', 'create_history', create_history)
+    if hist is None:
+        return test_suites
+
+    def fetch(name):
+        with xunit('galaxy', 'pipeline.retrieve') as tc_stage, tracer.span('retrieve', organism=name):
+            datasets, fetch_test_cases = retrieve_and_rename(gi, hist, name, export_cache)
+            # Every organism needs every input, or the elements won't line up
+            missing = [source for source in inputs.values() if not isinstance(source, dict) and source not in datasets]
+            if missing:
+                raise Exception("Export of %s has no %s" % (name, ', '.join(missing)))
+        if tc_stage._tc.is_failure():
+            return xunit_suite('[%s] Pipeline' % name, [tc_stage]), None
+        return xunit_suite('[%s] Fetching Data' % name, fetch_test_cases), datasets
+
+    org_datasets = {}
+    with ThreadPoolExecutor(max_workers=max_fetch) as pool:
+        for name, (ts, datasets) in zip(org_names, pool.map(fetch, org_names)):
+            emit(ts)
+            if datasets is not None:
+                org_datasets[name] = datasets
+    names = [name for name in org_names if name in org_datasets]
+    if not names:
+        return test_suites
+
+    if slots is not None:
+        # Batched runs share one wall-clock, so the plan only orders them
+        if plan is not None:
+            slots.acquire(plan.total(wf['id'], names))
+        else:
+            slots.acquire()
+    if admission is not None:
+        admission.admit()
+    try:
+        with xunit('galaxy', 'workflow_launch') as tc_invoke, tracer.span('workflow_launch', workflow=wf['id']):
+            batch_inputs = {}
+            for step, source in inputs.items():
+                if isinstance(source, dict):
+                    batch_inputs[str(step)] = source
+                    continue
+                collection = gi.histories.create_dataset_collection(hist['id'], {
+                    'collection_type': 'list',
+                    'name': '%s.%s' % (wf['name'], source),
+                    'element_identifiers': [
+                        {'name': name, 'src': 'hda', 'id': org_datasets[name][source]['id']}
+                        for name in names
+                    ],
+                })
+                # Linked (not product) batch values: element i of every input
+                # goes to the same run
+                batch_inputs[str(step)] = {
+                    'batch': True,
+                    'product': False,
+                    'values': [{'src': 'hdca', 'id': collection['id']}],
+                }
+            logging.info("Running wf %s in batch over %s organisms in %s", wf['id'], len(names), hist['id'])
+            invocations = gi.workflows._post({
+                'workflow_id': wf['id'],
+                'inputs': batch_inputs,
+                'history': 'hist_id=%s' % hist['id'],
+                'no_add_to_history': True,
+                'batch': True,
+            }, url=gi.workflows._invocations_url(wf['id']))
+        emit(xunit_suite('[%s] Invoking workflow' % 'Batch', [tc_invoke]))
+        if tc_invoke._tc.is_failure():
+            return test_suites
+
+        if isinstance(invocations, list):
+            # One invocation per element, in element order
+            ready = [(name, invocation) for name, invocation in zip(names, invocations)
+                     if stage(name, 'ready', wait_for_invocation_ready,
+                              gi, wf['id'], invocation['id'], ready_timeout) is not None]
+            if not ready:
+                return test_suites
+            with ThreadPoolExecutor(max_workers=len(ready)) as pool:
+                watches = pool.map(lambda item: watch_one(gi, wf['id'], item[1]['id'], poller, timings), ready)
+                for (name, invocation), tc_watch in zip(ready, watches):
+                    emit(completion(name, invocation['id'], tc_watch))
+        else:
+            # A single mapped-over invocation, split by output collection element
+            if stage('Batch', 'ready', wait_for_invocation_ready,
+                     gi, wf['id'], invocations['id'], ready_timeout) is None:
+                return test_suites
+            tc_watch = watch_one(gi, wf['id'], invocations['id'], poller, timings)
+            emit(completion('Batch', invocations['id'], tc_watch))
+            for ts in split_mapped_results(gi, hist, wf['id'], invocations['id'], names):
+                emit(ts)
+    finally:
+        if admission is not None:
+            admission.done()
+        if slots is not None:
+            slots.release()
+    return test_suites
+
+
+def mapped_element_states(gi, hist, wf_id, invoke_id):
+    # (failed, pending): output dataset ids of a mapped-over invocation by
+    # element identifier, for those that errored and those not finished yet
+    failed = {}
+    pending = {}
+    invocation = gi.workflows.show_invocation(wf_id, invoke_id)
+    for output in invocation.get('output_collections', {}).values():
+        collection = gi.histories.show_dataset_collection(hist['id'], output['id'])
+        if collection.get('populated_state', 'ok') != 'ok':
+            pending.setdefault(None, []).append(output['id'])
+        for element in collection['elements']:
+            state = element['object'].get('state')
+            if state in FAILED_DATASET_STATES:
+                failed.setdefault(element['element_identifier'], []).append(element['object']['id'])
+            elif state in PENDING_DATASET_STATES:
+                pending.setdefault(element['element_identifier'], []).append(element['object']['id'])
+    return failed, pending
+
+
+def split_mapped_results(gi, hist, wf_id, invoke_id, names):
+    # Per-organism results of a mapped-over invocation: an organism fails if
+    # any element named after it in an output collection failed. Waits for
+    # every element to finish first.
+    key = ('mapped', wf_id, invoke_id)
+    prev_pending = None
+    try:
+        while True:
+            failed, pending = mapped_element_states(gi, hist, wf_id, invoke_id)
+            if not pending:
+                break
+            logging.info("%s elements of invocation %s unfinished", sum(map(len, pending.values())), invoke_id)
+            scheduler.wait(key, changed=pending != prev_pending)
+            prev_pending = pending
+    finally:
+        scheduler.forget(key)
+
+    test_suites = []
+    for name in names:
+        with xunit('galaxy', 'workflow_watch.%s.%s.%s' % (wf_id, invoke_id, name)) as tc_watch:
+            if name in failed:
+                raise Exception("Outputs %s failed" % ', '.join(failed[name]))
+        test_suites.append(xunit_suite('[%s] Workflow Completion' % name, [tc_watch]))
+    return test_suites
+
+
+if __name__ == "__main__":
+    __main__()
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
-import argparse
 import os
 import time
+import argparse
 import logging
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 from justbackoff import Backoff
-from bioblend import galaxy
-from xunit_wrapper import xunit, xunit_suite, xunit_dump
+from bioblend import ConnectionError
+from cache import CACHE_DB
+from checkpoint import case_result, default_path, resumed_case
+from poller import StatePoller, job_states, scheduler
+from metrics import completion_cases
+from tracing import tracer
+from xunit_wrapper import xunit, xunit_suite
 
 
 logging.basicConfig(format='[%(asctime)s][%(lineno)d][%(module)s] %(message)s', level=logging.DEBUG)
@@ -14,94 +22,252 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("bioblend").setLevel(logging.WARNING)
 NOW = datetime.datetime.now()
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-backoff = Backoff(min_ms=100, max_ms=1000 * 60 * 5, factor=2, jitter=False)
 BUILD_ID = os.environ.get('BUILD_NUMBER', 'Manual-%s' % NOW.strftime('%Y.%m.%dT%H:%M'))
 
 def __main__():
-    parser = argparse.ArgumentParser(description="""Script to run all workflows mentioned in workflows_to_test.
-    It will import the shared workflows are create histories for each workflow run, prefixed with ``TEST_RUN_<date>:``
-    Make sure the yaml has file names identical to those in the data library.""")
+    # The Annotation entry of testdata/pipelines.yaml; run_matrix imports
+    # this module, so it is only imported here
+    import run_matrix
+    run_matrix.__main__(__file__, 'b5c00abe58f400a6')
+
 
+def positive_float(value):
+    # argparse type for rates, which must be above zero
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("must be greater than 0: %s" % value)
+    return number
+
+
+def add_common_args(parser, script, pipeline=True):
+    # Flags every workflow runner takes; ``script`` names the default
+    # checkpoint, and ``pipeline`` adds those of run_pipeline's exports,
+    # invocations and admission control
     parser.add_argument('-k', '--api-key', '--key', dest='key', metavar='your_api_key',
                         help='The account linked to this key needs to have admin right to upload by server path',
                         required=True)
     parser.add_argument('-u', '--url', dest='url', metavar="http://galaxy_url:port",
                         help="Be sure to specify the port on which galaxy is running",
                         default="http://usegalaxy.org")
-    parser.add_argument('-x', '--xunit-output', dest="xunit_output", type=argparse.FileType('w'), default='report.xml',
-                        help="""Location to store xunit report in""")
-    args = parser.parse_args()
-
-    WORKFLOW_ID = 'b5c00abe58f400a6'
-    gi = galaxy.GalaxyInstance(args.url, args.key)
-    wf = gi.workflows.get_workflows(workflow_id=WORKFLOW_ID)[0]
-    inputMap = gi.workflows.show_workflow(WORKFLOW_ID)['inputs']
-    # import json
-    # print(json.dumps(inputMap, indent=2))
-    # import sys; sys.exit()
-
-    # org_names = ('Soft', '2ww-3119', 'ISA', 'Inf_Still_Creek', 'J76', 'K6',
-                 # 'K7', 'K8', 'MIS1-LT2', 'MIS3-3117', 'MP16', 'Pin', 'SCI',
-                 # 'SCS', 'SL-Ken', 'ScaAbd', 'ScaApp', 'Sw1_3003', 'Sw2-Ken',
-                 # 'UDP', '5ww_LT2', 'CCS')
-
-    org_names = ('Sw2-Ken',)
-
-    wf_data = gi.workflows.show_workflow(wf['id'])
-    wf_inputs = wf_data['inputs']
-    test_suites = []
-    wf_invocations = []
-    for name in org_names:
-        hist = gi.histories.create_history(name='BuildID=%s WF=%s Org=%s Source=Jenkins' % (BUILD_ID, wf_data['name'].replace(' ', '_'), name))
+    parser.add_argument('-x', '--xunit-output', dest="xunit_output", default='report.xml',
+                        help="""Location to store xunit report in, updated as each test finishes""")
+    parser.add_argument('--cache-db', dest="cache_db", default=CACHE_DB,
+                        help="""Local cache of exports, uploads, step timings and the run history""")
+    parser.add_argument('--max-rps', dest="max_rps", type=positive_float, default=scheduler.rate,
+                        help="""Most polling requests per second to make of galaxy, across all watchers""")
+    parser.add_argument('--no-predict', dest="predict", action="store_false", default=True,
+                        help="""Don't time polls or order runs by how long they took in previous builds""")
+    parser.add_argument('--no-step-metrics', dest="step_metrics", action="store_false", default=True,
+                        help="""Don't report each job's timings and metrics, or write them next to the xunit report""")
+    parser.add_argument('--no-history', dest="history", action="store_false", default=True,
+                        help="""Don't record this build's durations in the run history (see compare_runs.py)""")
+    parser.add_argument('--checkpoint', dest="checkpoint", default=default_path(script),
+                        help="""Journal of the histories, datasets and invocations this run creates""")
+    parser.add_argument('--resume', dest="resume", action="store_true", default=False,
+                        help="""Carry on from the checkpoint of an interrupted run, watching its invocations again""")
+    parser.add_argument('--trace', dest="trace", default=None,
+                        help="""Write a Chrome trace (chrome://tracing, Perfetto) of every galaxy API call to this file""")
+    if not pipeline:
+        return
+    parser.add_argument('--ready-timeout', dest="ready_timeout", type=float, default=60,
+                        help="""Seconds to wait for galaxy to start scheduling each invocation""")
+    parser.add_argument('--no-export-cache', dest="export_cache", action="store_false", default=True,
+                        help="""Always run a fresh Webapollo export""")
+    parser.add_argument('--max-queued', dest="max_queued", type=int, default=None,
+                        help="""Only submit while fewer than this many of our jobs are new, queued or running on the server""")
+    parser.add_argument('--max-in-flight', dest="max_inflight", type=int, default=None,
+                        help="""Only submit while fewer than this many of our invocations are unfinished""")
+
+
+def map_inputs(datasets):
+    # TODO: fix mapping to always work.
+    # Map our inputs for invocation
+    return {
+        '0': {
+            'id': datasets['fasta']['id'],
+            'src': 'hda',
+        },
+        '1': {
+            'id': datasets['json']['id'],
+            'src': 'hda',
+        },
+        '2': {
+            'id': datasets['gff3']['id'],
+            'src': 'hda',
+        }
+    }
+
+
+def run_pipeline(gi, wf, org_names, history_name, map_inputs, queue_size=2, poller=None, ready_timeout=60,
+                 export_cache=None, slots=None, label=None, timings=None, plan=None, admission=None,
+                 checkpoint=None, report=None, step_metrics=None, history=None):
+    # Each organism flows through history setup -> data retrieval -> invocation
+    # -> watching, with bounded queues between the stages, so organism N+1 is
+    # fetching its data while organism N is already being invoked and watched.
+    # ``slots`` (a semaphore, or with a plan a planning.PrioritySlots, possibly
+    # shared between pipelines) caps the number of invocations running at
+    # once; ``label`` is set as each suite's workflow property.
+    # ``timings`` (a cache.StepTimings) lets watchers time their polls,
+    # ``plan`` (a planning.Plan) starts the longest expected organisms first,
+    # and ``admission`` (a planning.AdmissionController) holds invocations
+    # back while the server is busy with ours.
+    # ``checkpoint`` (a checkpoint.Checkpoint) records each stage as it
+    # finishes; stages it already holds are skipped, and invocations it holds
+    # are watched again rather than resubmitted.
+    # ``report`` (a report.XunitReport) gets each suite as soon as it is made,
+    # ``step_metrics`` (a metrics.StepMetrics) adds a test case per job to
+    # each completion suite, and ``history`` (a cache.RunHistory) records
+    # the durations of each passing run.
+    if poller is None:
+        poller = StatePoller(gi)
+    org_suites = {name: [] for name in org_names}
+    histories = Queue(maxsize=queue_size)
+    fetched = Queue(maxsize=queue_size)
+    watches = []
+    order = org_names if plan is None else plan.order(wf['id'], org_names)
+
+    def key(name):
+        return '%s:%s' % (wf['id'], name)
+
+    def resumed(name):
+        return {} if checkpoint is None else checkpoint.get(key(name))
+
+    def record(name, field, value):
+        if checkpoint is not None:
+            checkpoint.record(key(name), field, value)
+
+    def emit(name, suite):
+        if label is not None:
+            suite.properties = {'workflow': label}
+        org_suites[name].append(suite)
+        if report is not None:
+            report.add(suite)
+
+    def stage(name, stage_name, func, *args):
+        # A failing organism is reported and dropped, the others carry on
+        with xunit('galaxy', 'pipeline.%s' % stage_name) as tc_stage, tracer.span(stage_name, organism=name):
+            result = func(*args)
+        if tc_stage._tc.is_failure():
+            emit(name, xunit_suite('[%s] Pipeline' % name, [tc_stage]))
+            return None
+        return result
+
+    def create_history(name):
+        hist = gi.histories.create_history(name=history_name % name)
         gi.histories.create_history_tag(hist['id'], 'Automated')
         gi.histories.create_history_tag(hist['id'], 'Annotation')
         gi.histories.create_history_tag(hist['id'], 'BICH464')
-        # Load the datasets into history
-        datasets, fetch_test_cases = retrieve_and_rename(gi, hist, name)
-        ts = xunit_suite('[%s] Fetching Data' % name, fetch_test_cases)
-        test_suites.append(ts)
+        return hist
 
-        # TODO: fix mapping to always work.
-        # Map our inputs for invocation
-        inputs = {
-            '0': {
-                'id': datasets['fasta']['id'],
-                'src': 'hda',
-            },
-            '1': {
-                'id': datasets['json']['id'],
-                'src': 'hda',
-            },
-            '2': {
-                'id': datasets['gff3']['id'],
-                'src': 'hda',
-            }
-        }
+    def setup_stage():
+        try:
+            for name in order:
+                done = resumed(name)
+                if 'result' in done:
+                    tc_watch = resumed_case('workflow_watch.%s.%s' % tuple(done['invocation']), done['result'])
+                    emit(name, xunit_suite('[%s] Workflow Completion' % name, [tc_watch]))
+                    continue
+                hist = done.get('history')
+                if hist is None:
+                    hist = stage(name, 'create_history', create_history, name)
+                    if hist is None:
+                        continue
+                    record(name, 'history', {'id': hist['id'], 'name': hist['name']})
+                histories.put((name, hist))
+        finally:
+            histories.put(None)
+
+    def fetch_stage():
+        try:
+            for (name, hist) in iter(histories.get, None):
+                datasets = resumed(name).get('datasets')
+                if datasets is not None:
+                    fetch_test_cases = [resumed_case('resumed.retrieve')]
+                else:
+                    # Load the datasets into history
+                    fetch = stage(name, 'retrieve', retrieve_and_rename, gi, hist, name, export_cache)
+                    if fetch is None:
+                        continue
+                    datasets, fetch_test_cases = fetch
+                    record(name, 'datasets', {ext: {'id': dataset['id']} for ext, dataset in datasets.items()})
+                emit(name, xunit_suite('[%s] Fetching Data' % name, fetch_test_cases))
+                fetched.put((name, hist, datasets))
+        finally:
+            fetched.put(None)
 
+    def invoke(name, hist, datasets):
+        inputs = map_inputs(datasets)
         # Invoke Workflow
         wf_test_cases, watchable_invocation = run_workflow(gi, wf, inputs, hist)
-        # Give galaxy time to process
-        time.sleep(10)
-        # Invoke Workflow test cases
-        ts = xunit_suite('[%s] Invoking workflow' % name, wf_test_cases)
-        test_suites.append(ts)
-        # Store the invocation info for watching later.
-        wf_invocations.append(watchable_invocation)
-
-    invoke_test_cases = []
-    for (wf_id, invoke_id) in wf_invocations:
-        with xunit('galaxy', 'workflow_watch.%s.%s' % (wf_id, invoke_id)) as tc_watch:
-            logging.info("Waiting on wf %s invocation %s", wf_id, invoke_id)
-            watch_workflow_invocation(gi, wf_id, invoke_id)
-        invoke_test_cases.append(tc_watch)
-    ts = xunit_suite('[%s] Workflow Completion' % name, invoke_test_cases)
-    args.xunit_output.write(xunit_dump(test_suites))
+        record(name, 'invocation', list(watchable_invocation))
+        # Wait until galaxy has picked it up
+        wait_for_invocation_ready(gi, *watchable_invocation, deadline=ready_timeout)
+        return wf_test_cases, watchable_invocation
+
+    def watch(name, wf_id, invoke_id, started, reattached=False):
+        try:
+            tc_watch = watch_one(gi, wf_id, invoke_id, poller, timings)
+            record(name, 'result', case_result(tc_watch))
+            watch_test_cases = completion_cases(gi, wf_id, invoke_id, tc_watch, name, step_metrics, history)
+            emit(name, xunit_suite('[%s] Workflow Completion' % name, watch_test_cases))
+            if plan is not None:
+                # A reattached run's wall-clock started in an earlier run
+                plan.end(wf['id'], name, started, ok=not tc_watch._tc.is_failure() and not reattached)
+            return tc_watch
+        finally:
+            release()
+
+    def release():
+        if admission is not None:
+            admission.done()
+        if slots is not None:
+            slots.release()
+
+    def invoke_stage():
+        for (name, hist, datasets) in iter(fetched.get, None):
+            if slots is not None:
+                if plan is not None:
+                    slots.acquire(plan.priority(wf['id'], name))
+                else:
+                    slots.acquire()
+            if admission is not None:
+                admission.admit()
+            started = time.time() if plan is None else plan.begin()
+            invocation = resumed(name).get('invocation')
+            if invocation is not None:
+                wf_test_cases, (wf_id, invoke_id) = [resumed_case('resumed.invoke')], invocation
+                logging.info("Reattaching to wf %s invocation %s", wf_id, invoke_id)
+            else:
+                invoked = stage(name, 'invoke', invoke, name, hist, datasets)
+                if invoked is None:
+                    release()
+                    continue
+                wf_test_cases, (wf_id, invoke_id) = invoked
+            # Invoke Workflow test cases
+            emit(name, xunit_suite('[%s] Invoking workflow' % name, wf_test_cases))
+            # Start watching straight away
+            watches.append(watchers.submit(watch, name, wf_id, invoke_id, started, invocation is not None))
+
+    with ThreadPoolExecutor(max_workers=max(len(org_names), 1)) as watchers:
+        stages = [threading.Thread(target=target) for target in (setup_stage, fetch_stage)]
+        for thread in stages:
+            thread.start()
+        invoke_stage()
+        for thread in stages:
+            thread.join()
+        for future in as_completed(watches):
+            future.result()
+
+    test_suites = []
+    for name in org_names:
+        test_suites.extend(org_suites[name])
+    return test_suites
 
 
 def run_workflow(gi, wf, inputs, hist):
     test_cases = []
 
-    with xunit('galaxy', 'workflow_launch') as tc_invoke:
+    with xunit('galaxy', 'workflow_launch') as tc_invoke, tracer.span('workflow_launch', workflow=wf['id']):
         logging.info("Running wf %s in %s", wf['id'], hist['id'])
         invocation = gi.workflows.invoke_workflow(
             wf['id'],
@@ -114,10 +280,38 @@ def run_workflow(gi, wf, inputs, hist):
 
     return test_cases, watchable_invocation
 
-def retrieve_and_rename(gi, hist, ORG_NAME):
+def wait_for_invocation_ready(gi, wf_id, invoke_id, deadline=60):
+    # Probe until the invocation has left the 'new' state or its steps have
+    # appeared, giving up (but carrying on) after ``deadline`` seconds.
+    backoff = Backoff(min_ms=250, max_ms=1000 * 5, factor=2, jitter=False)
+    give_up = time.time() + deadline
+    with tracer.span('invocation_ready', invocation=invoke_id):
+        while True:
+            scheduler.acquire()
+            latest_state = gi.workflows.show_invocation(wf_id, invoke_id)
+            if latest_state['state'] != 'new' or latest_state['steps']:
+                logging.debug("Invocation %s is %s", invoke_id, latest_state['state'])
+                return latest_state
+            remaining = give_up - time.time()
+            if remaining <= 0:
+                logging.warning("Invocation %s still new after %ss, watching anyway", invoke_id, deadline)
+                return latest_state
+            time.sleep(min(backoff.duration(), remaining))
+
+
+def retrieve_and_rename(gi, hist, ORG_NAME, export_cache=None):
     logging.info("Retrieving and Renaming %s", ORG_NAME)
+    signal = None
+    if export_cache is not None:
+        # Reuse the last export if the annotations haven't changed since
+        signal, cached = export_cache.lookup(gi, ORG_NAME)
+        if cached is not None:
+            with xunit('galaxy', 'copy_cached_export') as tc_cached, tracer.span('copy_cached_export'):
+                logging.info("Copying cached export of %s", ORG_NAME)
+                datasets = export_cache.copy_into(gi, hist, ORG_NAME, cached)
+            return datasets, [tc_cached]
     # Now we'll run this tool
-    with xunit('galaxy', 'launch_tool') as tc3:
+    with xunit('galaxy', 'launch_tool') as tc3, tracer.span('launch_tool', organism=ORG_NAME):
         logging.info("Running tool")
         inputs = {
             'org_source|source_select': 'direct',
@@ -141,62 +335,177 @@ def retrieve_and_rename(gi, hist, ORG_NAME):
         # Keep a copy by extension
         datasets[dataset['file_ext']] = dataset
 
-    return datasets, [tc3]
+    test_cases = [tc3]
+    if export_cache is not None:
+        # Only a finished export is worth reusing, so this one waits for it
+        with xunit('galaxy', 'watch_run') as tc4, tracer.span('watch_run', organism=ORG_NAME):
+            watch_job_invocation(gi, tool_run['jobs'][0]['id'])
+        test_cases.append(tc4)
+        if not tc4._tc.is_failure():
+            export_cache.record(ORG_NAME, signal, {ext: dataset['id'] for ext, dataset in datasets.items()})
+    return datasets, test_cases
 
 
-def watch_job_invocation(gi, job_id):
+def watch_workflow_invocations(gi, wf_invocations, max_workers=None, poller=None, timings=None):
+    # Watch all invocations together, yielding each test case as soon as its
+    # invocation reaches a terminal state rather than in submission order.
+    wf_invocations = list(wf_invocations)
+    if not wf_invocations:
+        return
+    # All watchers share one poller, so each tick is a single batch of requests
+    if poller is None:
+        poller = StatePoller(gi)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(wf_invocations)) as pool:
+        futures = [pool.submit(watch_one, gi, wf_id, invoke_id, poller, timings)
+                   for (wf_id, invoke_id) in wf_invocations]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def watch_one(gi, wf_id, invoke_id, poller=None, timings=None):
+    with xunit('galaxy', 'workflow_watch.%s.%s' % (wf_id, invoke_id)) as tc_watch, \
+            tracer.span('workflow_watch', invocation=invoke_id):
+        logging.info("Waiting on wf %s invocation %s", wf_id, invoke_id)
+        watch_workflow_invocation(gi, wf_id, invoke_id, poller=poller, timings=timings)
+    return tc_watch
+
+
+def watch_job_invocation(gi, job_id, poller=None, on_change=None):
+    # ``on_change`` is called with each new state the job is seen in
     latest_state = None
     prev_state = None
+    key = ('job', job_id)
 
-    while True:
-        # Fetch the current state
-        latest_state = gi.jobs.get_state(job_id)
-        # If the state changes
-        if latest_state != prev_state:
-            # Reset the backoff
-            backoff.reset()
-        prev_state = latest_state
-
-        # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
-        logging.debug("Checking job %s state: %s", job_id, latest_state)
-        if latest_state == 'error':
-            raise Exception(latest_state)
-        elif latest_state == 'ok':
-            return
-        else:
-            time.sleep(backoff.duration())
-    raise Exception(latest_state)
+    try:
+        while True:
+            # Fetch the current state
+            if poller is not None:
+                latest_state = poller.get_state(job_id)
+            else:
+                latest_state = job_states.get_state(gi, job_id)
 
+            # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
+            logging.debug("Checking job %s state: %s", job_id, latest_state)
+            if on_change is not None and latest_state != prev_state:
+                on_change(latest_state)
+            if latest_state == 'error':
+                raise Exception(latest_state)
+            elif latest_state == 'ok':
+                return
+            # Poll again sooner if the state just changed
+            # (job_states takes its request from the budget itself)
+            scheduler.wait(key, changed=latest_state != prev_state, request=False)
+            prev_state = latest_state
+    finally:
+        scheduler.forget(key)
+
+
+def expected_wait(gi, wf_id, steps, started, timings):
+    # Seconds until the first running step should finish, going by how long
+    # the same steps took before; None if nothing running has a history.
+    remaining = []
+    for step in steps:
+        job_id = step.get('job_id')
+        if job_id not in started:
+            continue
+        expected = timings.expected(gi, wf_id, step)
+        if expected is not None:
+            remaining.append(expected - (time.time() - started[job_id]))
+    return min(remaining) if remaining else None
+
+
+def invocation_jobs_summary(gi, invoke_id):
+    # {job state: count} for the invocation, a few bytes however many steps
+    # it has. None if the server has no summaries (older galaxy).
+    try:
+        summary = gi.workflows._get(url='%s/invocations/%s/jobs_summary' % (gi.url, invoke_id))
+    except ConnectionError as e:
+        logging.debug("No jobs summary for invocation %s: %s", invoke_id, e)
+        return None
+    return summary.get('states', {})
 
-def watch_workflow_invocation(gi, wf_id, invoke_id):
+
+def watch_workflow_invocation(gi, wf_id, invoke_id, poller=None, timings=None, max_delay=None):
     latest_state = None
     prev_state = None
-    while True:
-        # Fetch the current state
-        latest_state = gi.workflows.show_invocation(wf_id, invoke_id)
-        # Get step states
-        states = [step['state'] for step in latest_state['steps']]
-        # Get a str based state representation
-        state_rep = '|'.join(map(str, states))
-        if state_rep != prev_state:
-            backoff.reset()
-        prev_state = state_rep
-
-        # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
-        if latest_state['state'] == 'scheduled':
-            # If any state is in error,
-            logging.info("Checking workflow %s states: %s", wf_id, state_rep)
-            if any([state == 'error' for state in states]):
-                # We bail
-                raise Exception(latest_state)
+    key = ('invocation', wf_id, invoke_id)
+    # job_id -> when we first saw it unfinished
+    started = {}
+    # Once scheduled, polls only need job state counts; the full steps are
+    # fetched to report an error, or to time steps when something changed.
+    # (The poller already builds its documents from listings.)
+    summaries = poller is None
+    try:
+        while True:
+            summary = None
+            if summaries and latest_state is not None and latest_state['state'] == 'scheduled':
+                summary = invocation_jobs_summary(gi, invoke_id)
+                summaries = summary is not None
+                if not summary:
+                    # No jobs yet, or none at all: the steps tell which
+                    summary = None
+            if summary is not None:
+                state_rep = 'scheduled:%s' % '|'.join('%s=%s' % item for item in sorted(summary.items()))
+                logging.info("Checking workflow %s jobs: %s", wf_id, state_rep)
+                if 'error' in summary:
+                    scheduler.acquire()
+                    raise Exception(gi.workflows.show_invocation(wf_id, invoke_id))
+                if all([state == 'ok' for state in summary]):
+                    return
+                if timings is None or state_rep == prev_state:
+                    expected = None
+                    if timings is not None:
+                        expected = expected_wait(gi, wf_id, latest_state['steps'], started, timings)
+                    scheduler.wait(key, changed=state_rep != prev_state, expected=expected, max_delay=max_delay)
+                    prev_state = state_rep
+                    continue
+                scheduler.acquire()
 
-            # If all OK
-            if all([state is None or state == 'ok'
-                    for state in states]):
-                return
-                # We can finish
-        time.sleep(backoff.duration())
-    raise Exception(latest_state)
+            # Fetch the current state
+            if poller is not None:
+                latest_state = poller.show_invocation(wf_id, invoke_id)
+            else:
+                latest_state = gi.workflows.show_invocation(wf_id, invoke_id)
+            # Get step states
+            states = [step['state'] for step in latest_state['steps']]
+            # Get a str based state representation
+            if summary is None:
+                state_rep = '%s:%s' % (latest_state['state'], '|'.join(map(str, states)))
+            if timings is not None:
+                for step in latest_state['steps']:
+                    job_id = step.get('job_id')
+                    if not job_id:
+                        continue
+                    if step['state'] not in ('ok', 'error', 'deleted'):
+                        started.setdefault(job_id, time.time())
+                    elif step['state'] == 'ok' and started.pop(job_id, None) is not None:
+                        # Only jobs we saw running, so each is recorded once
+                        timings.record(gi, wf_id, step)
+
+            # If it's scheduled, then let's look at steps. Otherwise steps probably don't exist yet.
+            if latest_state['state'] == 'scheduled':
+                # If any state is in error,
+                logging.info("Checking workflow %s states: %s", wf_id, '|'.join(map(str, states)))
+                if any([state == 'error' for state in states]):
+                    # We bail
+                    raise Exception(latest_state)
+
+                # If all OK
+                if all([state is None or state == 'ok'
+                        for state in states]):
+                    return
+                    # We can finish
+            # Invocations that are moving get polled sooner than idle ones, and
+            # ones with a step of known duration running wait for it to finish
+            expected = None
+            if timings is not None:
+                expected = expected_wait(gi, wf_id, latest_state['steps'], started, timings)
+            scheduler.wait(key, changed=state_rep != prev_state, request=poller is None, expected=expected,
+                           max_delay=max_delay)
+            prev_state = state_rep
+    finally:
+        scheduler.forget(key)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+import os
+import re
+import json
+import logging
+import time
+import threading
+import contextlib
+import requests
+from urllib.parse import urlsplit
+
+# Galaxy's encoded ids, folded out of endpoint names
+GALAXY_ID = re.compile(r'/[0-9a-f]{16}(?=/|$)')
+
+
+def endpoint(method, url):
+    # e.g. 'GET /api/workflows/{id}/invocations/{id}'; never the query, which holds the key
+    return '%s %s' % (method, GALAXY_ID.sub('/{id}', urlsplit(url).path))
+
+
+class Tracer(object):
+    """Spans of every HTTP request the harness makes and of the phases
+    (``create_history``, ``launch_tool``, ``workflow_launch``,
+    ``workflow_watch``, ...) around them, written out in Chrome's trace event
+    format for chrome://tracing or Perfetto.
+
+    Nothing is kept until ``start``. Spans nest by thread and time, as the
+    trace viewers expect, so requests show up under the phase that made them
+    on the same thread.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+
+    def start(self):
+        self.enabled = True
+
+    def add(self, name, started, duration, cat='phase', **args):
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': int(started * 1e6),
+            'dur': int(duration * 1e6),
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': args,
+        }
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        # A phase, timed whether or not what it wraps succeeds
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.time() - started, **args)
+
+    def summary(self):
+        # {endpoint: (calls, seconds)} of the requests so far
+        totals = {}
+        with self._lock:
+            for event in self._events:
+                if event['cat'] == 'http':
+                    calls, seconds = totals.get(event['name'], (0, 0.0))
+                    totals[event['name']] = (calls + 1, seconds + event['dur'] / 1e6)
+        return totals
+
+    def dump(self, path):
+        with self._lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}}
+                     for ident, name in self._threads.items()]
+            events = sorted(self._events, key=lambda event: event['ts'])
+        with open(path + '.tmp', 'w') as handle:
+            json.dump({'traceEvents': names + events, 'displayTimeUnit': 'ms'}, handle)
+        os.replace(path + '.tmp', path)
+        for name, (calls, seconds) in sorted(self.summary().items(), key=lambda item: -item[1][1]):
+            logging.info("%6s calls, %8.1fs: %s", calls, seconds, name)
+
+
+tracer = Tracer()
+
+
+class TracedSession(requests.Session):
+    """A ``requests.Session`` that records a span for each request it sends
+    with the global :data:`tracer`, once that is started."""
+
+    def send(self, request, **kwargs):
+        if not tracer.enabled:
+            return requests.Session.send(self, request, **kwargs)
+        started = time.time()
+        status = None
+        received = 0
+        try:
+            r = requests.Session.send(self, request, **kwargs)
+            status = r.status_code
+            if kwargs.get('stream'):
+                received = int(r.headers.get('Content-Length') or 0)
+            else:
+                received = len(r.content)
+            return r
+        finally:
+            body = request.body
+            # Multipart uploads are streamed from an encoder that knows its length
+            sent = len(body) if isinstance(body, (bytes, str)) else getattr(body, 'len', 0)
+            tracer.add(endpoint(request.method, request.url), started, time.time() - started, cat='http',
+                       status=status, sent=sent, received=received)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import base64
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from cache import hash_file, copy_dataset
+
+TUS_VERSION = '1.0.0'
+CHUNK_SIZE = 10 * 1024 * 1024
+
+
+class ResumableUploadUnsupported(Exception):
+    """The server has no resumable (TUS) upload endpoint."""
+
+
+class ChunkedUploader(object):
+    """Upload files into a history through Galaxy's resumable (TUS) upload
+    endpoint, one chunk at a time and several files at once.
+
+    Upload urls are remembered in ``state_path``, keyed on each file's path,
+    size and mtime, so an upload interrupted in this run or a previous one
+    picks up again from the last offset the server acknowledged.
+
+    Servers without the endpoint get each file in one request through the
+    upload tool instead, as ``gi.tools.upload_file`` sends it.
+
+    With an ``index`` (a :class:`cache.UploadIndex`), files whose content is
+    already on the server are copied from the existing dataset instead.
+    """
+
+    def __init__(self, gi, max_workers=4, chunk_size=CHUNK_SIZE, retries=3, state_path='.uploads.json',
+                 index=None):
+        self.gi = gi
+        self.index = index
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.state_path = state_path
+        self.endpoint = gi.url + '/upload/resumable_upload/'
+        # Until the server shows it has no endpoint
+        self.resumable = True
+        # Share the client's connection pool when it has one
+        self.http = getattr(gi, 'session', requests)
+        self.timeout = getattr(gi, 'timeout', None)
+        self._lock = threading.Lock()
+        self._state = {}
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as handle:
+                self._state = json.load(handle)
+
+    def upload_files(self, paths, history_id):
+        # Returns the upload tool's response for each path, in order
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(lambda path: self.upload_file(path, history_id), paths))
+
+    def upload_file(self, path, history_id):
+        name = os.path.basename(path)
+        sha256 = None
+        if self.index is not None:
+            sha256 = hash_file(path)
+            dataset_id = self.index.lookup(self.gi, sha256)
+            if dataset_id is not None:
+                return self._copy(dataset_id, name, history_id)
+
+        result = None
+        if self.resumable:
+            try:
+                session_id = self._send(path)
+            except ResumableUploadUnsupported as e:
+                logging.warning("No resumable uploads on the server, uploading in one request: %s", e)
+                self.resumable = False
+            else:
+                # Hand the finished upload to the upload tool, as the web UI does
+                payload = self.gi.tools._upload_payload(history_id, file_name=name)
+                payload['inputs']['files_0|file_data'] = {'session_id': session_id, 'name': name}
+                result = self.gi.tools._tool_post(payload)
+                self._save(path, None)
+        if result is None:
+            result = self.gi.tools.upload_file(path, history_id, file_name=name)
+        if sha256 is not None:
+            self.index.record(sha256, result['outputs'][0]['id'], name)
+        return result
+
+    def _copy(self, dataset_id, name, history_id):
+        logging.info("%s is already on the server as %s, copying it", name, dataset_id)
+        dataset = copy_dataset(self.gi, history_id, dataset_id)
+        # Identical content may have been uploaded under another name
+        if dataset['name'] != name:
+            self.gi.histories.update_dataset(history_id, dataset['id'], name=name)
+            dataset['name'] = name
+        return {'outputs': [dataset]}
+
+    def _send(self, path):
+        size = os.path.getsize(path)
+        attempt = 0
+        while True:
+            try:
+                url, offset = self._resume(path, size)
+                with open(path, 'rb') as handle:
+                    while offset < size:
+                        handle.seek(offset)
+                        r = self.http.patch(url, data=handle.read(self.chunk_size), headers=self._headers({
+                            'Upload-Offset': str(offset),
+                            'Content-Type': 'application/offset+octet-stream',
+                        }), verify=self.gi.verify, timeout=self.timeout)
+                        r.raise_for_status()
+                        offset = int(r.headers['Upload-Offset'])
+                logging.debug("Uploaded %s (%s bytes)", path, size)
+                return url.rstrip('/').rsplit('/', 1)[-1]
+            except requests.RequestException as e:
+                # Client errors won't go away by trying again
+                response = getattr(e, 'response', None)
+                if response is not None and response.status_code < 500:
+                    raise
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                logging.warning("Upload of %s interrupted, resuming: %s", path, e)
+                time.sleep(2 ** attempt)
+
+    def _resume(self, path, size):
+        # Pick up a known upload where the server left it, or start a new one
+        url = self._state.get(self._key(path))
+        if url is not None:
+            r = self.http.head(url, headers=self._headers(), verify=self.gi.verify, timeout=self.timeout)
+            if r.status_code == 200:
+                offset = int(r.headers['Upload-Offset'])
+                logging.info("Resuming upload of %s at %s/%s bytes", path, offset, size)
+                return url, offset
+
+        r = self.http.post(self.endpoint, headers=self._headers({
+            'Upload-Length': str(size),
+            'Upload-Metadata': 'filename %s' % base64.b64encode(
+                os.path.basename(path).encode('utf-8')).decode('ascii'),
+        }), verify=self.gi.verify, timeout=self.timeout)
+        if r.status_code in (404, 405):
+            raise ResumableUploadUnsupported('%s %s' % (r.status_code, self.endpoint))
+        r.raise_for_status()
+        url = urljoin(self.endpoint, r.headers['Location'])
+        self._save(path, url)
+        return url, 0
+
+    def _headers(self, extra=None):
+        headers = {'Tus-Resumable': TUS_VERSION, 'x-api-key': self.gi.key}
+        headers.update(extra or {})
+        return headers
+
+    def _key(self, path):
+        stat = os.stat(path)
+        return '%s:%s:%s' % (os.path.realpath(path), stat.st_size, stat.st_mtime)
+
+    def _save(self, path, url):
+        with self._lock:
+            if url is None:
+                self._state.pop(self._key(path), None)
+            else:
+                self._state[self._key(path)] = url
+            # Write the whole state atomically so a crash can't corrupt it
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as handle:
+                json.dump(self._state, handle, indent=2)
+            os.replace(tmp_path, self.state_path)